@@ -1,80 +1,53 @@
 import pandas as pd
 
-def read_practice_data(filename, skiprows=None, date_column='date'):
-    df = pd.read_excel(filename, skiprows=skiprows, sheetname=None)
-    df['offensive']['day'] = df['offensive']['day'].ffill()
-    df['offensive']['name'] = df['offensive']['name'].ffill()
-    df['offensive']['type'] = df['offensive']['type'].ffill()
-    df['offensive'].index = df['offensive'][date_column]
-    df['defensive']['day'] = df['defensive']['day'].ffill()
-    df['defensive']['name'] = df['defensive']['name'].ffill()
-    df['defensive']['type'] = df['defensive']['type'].ffill()
-    df['defensive'].index = df['defensive'][date_column]
-    return df
-
-
-practices = read_practice_data('practices.xlsx')
-
-### Offensive Practices
-po = practices['offensive']
-rb = pd.pivot_table(po, values='length', index='name', columns=['qbrb'], aggfunc=np.sum)
-ol = pd.pivot_table(po, values='length', index='name', columns=['ot'], aggfunc=np.sum)
-wr = pd.pivot_table(po, values='length', index='name', columns=['wr'], aggfunc=np.sum)
-
-# Find the activities that the ols and the wrs have in common
-common = set(wr.columns) & set(ol.columns)
-for activity in common:
-    # Find those instances where the wrs were doing the activity but the ols weren't
-    mask = np.logical_and(np.isnan(ol[activity]), ~np.isnan(wr[activity]))
-    # Set the ol duration equal to the wr duration for these instances
-    ol.loc[mask, activity] = wr.loc[mask, activity]
-
-common = set(ol.columns) & set(rb.columns)
-for activity in common:
-    # Find those instances where the wrs were doing the activity but the ols weren't
-    mask = np.logical_and(np.isnan(rb[activity]), ~np.isnan(ol[activity]))
-    # Set the ol duration equal to the wr duration for these instances
-    rb.loc[mask, activity] = ol.loc[mask, activity]
-
-
-# add the columns in ol that aren't in ol to rb
-for column in ol.columns:
-    if column not in rb.columns:
-        rb[column] = ol[column]
-
-# output offensive activity durations
-#rb.to_csv('offensive_activity_durations.csv')
-offense = rb.copy()
-
-### Defensive Practices
-d = practices['defensive']
-dt = pd.pivot_table(d, values='length', index='name', columns=['dt'], aggfunc=np.sum)
-cb = pd.pivot_table(d, values='length', index='name', columns=['cb'], aggfunc=np.sum)
-
-# Find the activities that the dts and the cbs have in common
-common = set(dt.columns) & set(cb.columns)
-for activity in common:
-    # Find those instances where the cbs were doing the activity but the dts weren't
-    mask = np.logical_and(np.isnan(dt[activity]), ~np.isnan(cb[activity]))
-    # Set the dt duration equal to the cb duration for these instances
-    dt.loc[mask, activity] = cb.loc[mask, activity]
-
-# add the activities in cb that aren't in dt to dt
-for column in cb.columns:
-    if column not in dt.columns:
-        dt[column] = cb[column]
-
-# output offensive activity durations
-#dt.to_csv('defensive_activity_durations.csv')
-defense = dt.copy()
-
-
-# create a multiindex for a combined data frame
-tuples = list(zip(itertools.cycle(['offensive']), offense.columns)) + list(zip(itertools.cycle(['defensive']), defense.columns))
-idx = pd.MultiIndex.from_tuples(tuples)
-
-ref = dict(offensive=offense, defensive=defense)
-out = pd.DataFrame(index=offense.index, columns=idx)
-for col in out.columns:
-    out[col] = ref[col[0]][col[1]]
-out.to_csv('activity_durations.csv')
+# Position groups whose activity columns give each player type's activity
+# durations, in priority order: an activity's duration for a practice comes
+# from the first group doing that activity in it.
+POSITION_GROUPS = {'offensive': ['qbrb', 'ot', 'wr'],
+                   'defensive': ['dt', 'cb']}
+
+def get_activity_durations(practices, position_groups=POSITION_GROUPS):
+    """
+    get_activity_durations takes the practices returned by read_practice_data
+    and returns the duration of every activity of every practice for each
+    player type, indexed by practice name with (player type, activity)
+    columns. position_groups maps each player type to its position groups in
+    priority order (see POSITION_GROUPS). Columns are ordered by player type,
+    then by the first group doing the activity, then by activity.
+    """
+    # Stack the activity of every practice row for every position group into
+    # one long table
+    activities = []
+    for ptype, groups in position_groups.items():
+        practice = practices[ptype]
+        length = pd.to_numeric(practice['length'], errors='coerce').values
+        for priority, group in enumerate(groups):
+            activities.append(pd.DataFrame({'ptype': ptype,
+                                            'priority': priority,
+                                            'name': practice['name'].values,
+                                            'activity': practice[group].values,
+                                            'length': length}))
+    activities = (pd.concat(activities, ignore_index=True)
+                    .dropna(subset=['activity', 'length']))
+    # Total each activity's duration per practice and group, then coalesce
+    # the groups by keeping the first one with a duration
+    lengths = (activities.groupby(['ptype', 'name', 'activity', 'priority'])['length']
+                        .sum()
+                        .reset_index())
+    durations = (lengths.sort_values(by=['priority'], kind='mergesort')
+                        .drop_duplicates(['ptype', 'name', 'activity']))
+    columns = (lengths.groupby(['ptype', 'activity'])['priority']
+                      .min()
+                      .reset_index()
+                      .assign(order=lambda x: x.ptype.map(
+                          {ptype: i for i, ptype in enumerate(position_groups)}))
+                      .sort_values(by=['order', 'priority', 'activity']))
+    return (durations.set_index(['name', 'ptype', 'activity'])['length']
+                     .unstack(['ptype', 'activity'])
+                     .reindex(columns=pd.MultiIndex.from_arrays([columns.ptype.values,
+                                                                 columns.activity.values])))
+
+if __name__ == '__main__':
+    from compile_data import read_practice_data
+    practices = read_practice_data('practices.xlsx')
+    get_activity_durations(practices).to_csv('activity_durations.csv')
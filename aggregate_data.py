@@ -6,56 +6,47 @@ Created on Sun Feb 18 21:59:57 2018
 @author: martin
 """
 
-import pandas as pd
-import numpy as np
+from exposure_cube import load_cube, practice_totals, query_cube
+from resampling import bootstrap_medians, permutation_contrasts
 
-df_per_position = pd.read_csv('compile_by_position.csv', index_col=0)
-df_per_activity = pd.read_csv('compile_by_activity.csv', index_col=0)
-df_per_time = pd.read_csv('compile_by_time.csv', index_col=0)
-
-
-#games = df[df.type == 'game']
-#practices = df[df.type != 'game']
-#gtot = tot[tot.type == 'game']
-#ptot = tot[tot.type != 'game']
+# Exposure cubes are built once from the compiled data and reread afterwards
+per_position = load_cube('compiled_by_position.parquet')
+per_activity = load_cube('compiled_by_activity.parquet')
+tot = load_cube('compiled_total.parquet')
 
 # Question 1: What is the exposure to hits based on player position over all games?
-games = df_per_position[df_per_position.type == 'game']
-(games.groupby(['practice', 'player'], as_index=False)[['h1', 'h2', 'h3', 'h4', 'h5']]
-      .sum()
-      .groupby('player')
-      .aggregate(np.median))
+query_cube(per_position, 'player', where={'type': 'game'})
 
 # Question 2: What is the exposure to hits based on player position over all practices?
-practices = df_per_position[df_per_position.type != 'game']
-(practices.groupby(['practice', 'player'], as_index=False)[['h1', 'h2', 'h3', 'h4', 'h5']]
-          .sum()
-          .groupby('player')
-          .aggregate(np.median))
-          
-# Question 3: What is the exposure to hits based on player position be practice type?
-practices = df_per_position[df_per_position.type != 'game']
-(practices.groupby(['practice', 'type', 'player'], as_index=False)[['h1', 'h2', 'h3', 'h4', 'h5']]
-          .sum()
-          .groupby(['player', 'type'])
-          .aggregate(np.median))         
+query_cube(per_position, 'player', exclude={'type': 'game'})
 
+# Question 3: What is the exposure to hits based on player position be practice type?
+query_cube(per_position, ['player', 'type'], exclude={'type': 'game'})
 
 # Question 4: What is the exposure to hits based on player position by practice activity?
-practices = df_per_activity[df_per_activity.type != 'game']
-(practices.groupby(['practice', 'activity'], as_index=False)[['h1', 'h2', 'h3', 'h4', 'h5']]
-          .sum()
-          .groupby(['activity'])
-          .aggregate(np.median))
+query_cube(per_activity, 'activity', exclude={'type': 'game'})
 
 # Question 5a: What is the exposure to hits before and after break across all positions? (practices)
-(ptot.groupby(['practice', 'before_break'], as_index=False)[['h1', 'h2', 'h3', 'h4', 'h5']]
-     .sum()
-     .groupby(['before_break'])
-     .aggregate(np.median))
+query_cube(tot, 'before_break', exclude={'type': 'game'})
 
 # Question 5b: What is the exposure to hits before and after halftime across all positions? (games)
-(gtot.groupby(['practice', 'before_break'], as_index=False)[['h1', 'h2', 'h3', 'h4', 'h5']]
-     .sum()
-     .groupby(['before_break'])
-     .aggregate(np.median))
\ No newline at end of file
+query_cube(tot, 'before_break', where={'type': 'game'})
+
+# Inferential tests: bootstrap confidence intervals of the per-practice medians
+# and permutation tests of the null hypothesis of no difference in exposure
+totals = practice_totals(per_position, ['player', 'type'])
+totals['environment'] = totals['type'].astype(str).where(totals['type'] == 'game', 'practice')
+bootstrap_medians(totals, ['player', 'environment'], seed=0)
+
+# Games against practices, for each player position
+permutation_contrasts(totals, 'environment', by='player', seed=0)
+
+# Player positions against each other, in practices
+permutation_contrasts(totals[totals.environment == 'practice'], 'player', seed=0)
+
+# Practice types against each other, for each player position
+permutation_contrasts(totals[totals.environment == 'practice'], 'type', by='player', seed=0)
+
+# Practice activities against each other
+permutation_contrasts(practice_totals(per_activity, 'activity', exclude={'type': 'game'}),
+                      'activity', seed=0)
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Code to time the stages of the compile pipeline, record their peak memory
+and check their results against a reference, e.g. on synthetic seasons
+written by synthetic_season.py
+"""
+from __future__ import print_function, division
+import argparse
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import pandas as pd
+
+import compile_data as cd
+from exposure_cube import build_cube, query_cube
+
+NORM_METHODS = {'compiled_raw': (None, None),
+                'compiled_by_position': ('by_position', None),
+                'compiled_by_activity': ('by_activity', None),
+                'compiled_total': ('total', None)}
+
+# The aggregate_data questions, as (name, cube, query_cube arguments)
+QUERIES = [('q1_games_by_player', 'compiled_by_position',
+            {'by': 'player', 'where': {'type': 'game'}}),
+           ('q2_practices_by_player', 'compiled_by_position',
+            {'by': 'player', 'exclude': {'type': 'game'}}),
+           ('q3_practices_by_player_type', 'compiled_by_position',
+            {'by': ['player', 'type'], 'exclude': {'type': 'game'}}),
+           ('q4_practices_by_activity', 'compiled_by_activity',
+            {'by': 'activity', 'exclude': {'type': 'game'}}),
+           ('q5a_practices_by_break', 'compiled_total',
+            {'by': 'before_break', 'exclude': {'type': 'game'}}),
+           ('q5b_games_by_break', 'compiled_total',
+            {'by': 'before_break', 'where': {'type': 'game'}})]
+
+def run_stage(timings, name, func, *args, **kwargs):
+    """
+    run_stage calls func, records its wall time and its peak traced memory
+    (in MB) under name in timings and returns its result.
+    """
+    tracemalloc.reset_peak()
+    start_memory = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    timings[name] = {'seconds': time.perf_counter() - start,
+                     'peak_mb': (tracemalloc.get_traced_memory()[1] -
+                                 start_memory) / 2**20}
+    return result
+
+def run_benchmark(input_files, workdir, norm_methods=NORM_METHODS):
+    """
+    run_benchmark runs each stage of the pipeline on input_files once,
+    writing its files to workdir, and returns the timings of the stages and
+    their results (dataframes keyed by output name). The workbooks are read
+    twice, concurrently with an empty reader cache and then from the cache.
+    """
+    timings, results = {}, {}
+    cache_dir = cd.CACHE_DIR
+    cd.CACHE_DIR = os.path.join(workdir, '.cache')
+    shutil.rmtree(cd.CACHE_DIR, ignore_errors=True)
+    tracemalloc.start()
+    try:
+        run_stage(timings, 'read_input_files (cold)', cd.read_input_files,
+                  input_files, cd.get_input_keys(norm_methods))
+        tables = run_stage(timings, 'read_tables', cd.read_tables, input_files, norm_methods)
+        hits = run_stage(timings, 'read_hit_data', cd.read_hit_data, input_files['hits'])
+        run_stage(timings, 'resolve_hit_context', cd.resolve_hit_context, hits,
+                  tables['practices'], tables['practice_index'], tables['roster'])
+        results.update(run_stage(timings, 'compile_hits', cd.compile_hits,
+                                 hits, tables, norm_methods))
+        output = os.path.join(workdir, 'hits_not_during_events.csv')
+        run_stage(timings, 'get_hits_out_of_event', cd.get_hits_out_of_event,
+                  input_files, output)
+        results['hits_not_during_events'] = pd.read_csv(output, index_col=0)
+        results['practice_times_pre_post'] = run_stage(
+            timings, 'get_practice_times_pre_post',
+            cd.get_practice_times_pre_post, tables['practices'])
+        cubes = run_stage(timings, 'build_cube',
+                          lambda: {name: build_cube(results[name])
+                                   for name in set(q[1] for q in QUERIES)})
+        results.update(run_stage(timings, 'aggregate_queries',
+                                 lambda: {name: query_cube(cubes[cube], **kwargs)
+                                          for name, cube, kwargs in QUERIES}))
+    finally:
+        tracemalloc.stop()
+        cd.CACHE_DIR = cache_dir
+    return timings, results
+
+def normalize_result(df):
+    # Give a result the column types it has when read back from its CSV
+    return pd.read_csv(io.StringIO(df.to_csv()), index_col=0)
+
+def write_reference(results, directory):
+    """
+    write_reference writes every result to directory as <name>.csv.
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    for name, df in results.items():
+        df.to_csv(os.path.join(directory, '{}.csv'.format(name)))
+
+def check_drift(results, directory, rtol=1e-9):
+    """
+    check_drift compares every result with its reference CSV in directory
+    and returns a list of the results that differ (missing, or with other
+    labels or values, numbers being compared to a relative tolerance rtol).
+    """
+    drifted = []
+    for name, df in sorted(results.items()):
+        filename = os.path.join(directory, '{}.csv'.format(name))
+        if not os.path.exists(filename):
+            drifted.append('{}: no reference'.format(name))
+            continue
+        try:
+            pd.testing.assert_frame_equal(normalize_result(df),
+                                          pd.read_csv(filename, index_col=0),
+                                          check_exact=False, rtol=rtol)
+        except AssertionError as error:
+            drifted.append('{}: {}'.format(name, str(error).splitlines()[0]))
+    return drifted
+
+def print_timings(timings):
+    width = max(len(name) for name in timings)
+    for name, timing in timings.items():
+        print('{:<{}}  {:9.3f} s  {:9.1f} MB'.format(name, width, timing['seconds'],
+                                                     timing['peak_mb']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the compile pipeline on a set of input files.')
+    parser.add_argument('directory',
+                        help='directory of input files written by synthetic_season.py')
+    parser.add_argument('--reference',
+                        help='directory of reference outputs (default: <directory>/reference)')
+    parser.add_argument('--update', action='store_true',
+                        help='write the results as the new reference')
+    parser.add_argument('--timings', help='write the timings to this JSON file')
+    args = parser.parse_args()
+
+    input_files = {'hits': 'hits.xlsx',
+                   'practices': 'practices.xlsx',
+                   'attendance': 'attendance.xlsx',
+                   'event_types': 'event_type.xlsx',
+                   'pcode_to_ptype': 'player_code_to_type.xlsx',
+                   'psn_to_pcode': 'serial_number_to_position.xlsx'}
+    input_files = {key: os.path.join(args.directory, filename)
+                   for key, filename in input_files.items()}
+    reference = args.reference or os.path.join(args.directory, 'reference')
+
+    workdir = tempfile.mkdtemp()
+    try:
+        timings, results = run_benchmark(input_files, workdir)
+    finally:
+        shutil.rmtree(workdir)
+    print_timings(timings)
+    if args.timings:
+        with open(args.timings, 'w') as f:
+            json.dump(timings, f, indent=2)
+
+    if args.update or not os.path.exists(reference):
+        write_reference(results, reference)
+        print('Wrote reference outputs to {}'.format(reference))
+    else:
+        drifted = check_drift(results, reference)
+        for line in drifted:
+            print('Drift in', line)
+        if drifted:
+            sys.exit(1)
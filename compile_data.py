@@ -6,45 +6,318 @@ from __future__ import print_function, division
 import pandas as pd
 import numpy as np
 import toolz
-import copy
+import concurrent.futures
+import contextlib
+import datetime
+import functools
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import shutil
+import sys
+import time
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+from activity_durations import get_activity_durations
+
+# Directory holding the columnar cache of the cleaned input workbooks. Set to
+# None to always parse the workbooks.
+CACHE_DIR = '.cache'
+
+# Hit sensor sums that are compiled and normalized
+HIT_SUMS = ['sum 2', 'sum 3', 'sum 4', 'sum 5']
+
+# Columns of the compiled hit data stored as categoricals
+CATEGORICAL_COLUMNS = ['activity', 'before_break', 'event', 'pcode', 'player',
+                       'ptype', 'type']
+
+# Stage timings and counters recorded while profiling is on (see
+# start_profile), or None when it is off
+PROFILE = None
 
 #------------#
 # FUNCTIONS  #
 #------------#
+NS_PER_DAY = 24 * 60 * 60 * 10**9
+
+def start_profile(progress=False):
+    """
+    start_profile turns on profiling: every profile_stage records its
+    cumulative wall time, number of calls and number of hits processed, and
+    cached readers count their cache hits and misses. With progress, the
+    number of hits compiled so far is written to stderr after each batch.
+    Only the current process is profiled (not compile_parallel's workers).
+    """
+    global PROFILE
+    PROFILE = {'stages': {}, 'cache': {}, 'hits': 0, 'progress': progress}
+
+def stop_profile():
+    """
+    stop_profile turns off profiling and returns the report of what was
+    recorded since start_profile, as a dict that can be dumped to JSON (see
+    format_profile for a text report).
+    """
+    global PROFILE
+    profile, PROFILE = PROFILE, None
+    if profile is None:
+        return None
+    if profile['progress'] and profile['hits']:
+        print(file=sys.stderr)
+    stages = {}
+    for name, stage in profile['stages'].items():
+        stages[name] = dict(stage, us_per_hit=(1e6 * stage['seconds'] / stage['hits']
+                                               if stage['hits'] else None))
+    cache = {}
+    for reader, counts in profile['cache'].items():
+        calls = counts['hits'] + counts['misses']
+        cache[reader] = dict(counts, hit_rate=counts['hits'] / calls)
+    return {'hits': profile['hits'], 'stages': stages, 'cache': cache}
+
+def format_profile(report):
+    # Lay out a profile report as a text table
+    lines = ['{:<28}{:>10}{:>8}{:>10}{:>12}'.format('stage', 'seconds', 'calls',
+                                                   'hits', 'us/hit')]
+    for name, stage in sorted(report['stages'].items(),
+                              key=lambda item: -item[1]['seconds']):
+        lines.append('{:<28}{:>10.4f}{:>8}{:>10}{:>12}'.format(
+            name, stage['seconds'], stage['calls'], stage['hits'],
+            '' if stage['us_per_hit'] is None else '{:.2f}'.format(stage['us_per_hit'])))
+    if report['cache']:
+        lines.append('')
+        lines.append('{:<32}{:>8}{:>8}{:>10}'.format('cache', 'hits', 'misses', 'hit rate'))
+        for reader, counts in sorted(report['cache'].items()):
+            lines.append('{:<32}{:>8}{:>8}{:>10.0%}'.format(
+                reader, counts['hits'], counts['misses'], counts['hit_rate']))
+    lines.append('')
+    lines.append('{} hits compiled'.format(report['hits']))
+    return '\n'.join(lines)
+
+@contextlib.contextmanager
+def profile_stage(name, hits=0):
+    """
+    profile_stage times the code it wraps as the stage name, which processed
+    hits hits, when profiling is on.
+    """
+    if PROFILE is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage = PROFILE['stages'].setdefault(name, {'seconds': 0.0, 'calls': 0,
+                                                    'hits': 0})
+        stage['seconds'] += time.perf_counter() - start
+        stage['calls'] += 1
+        stage['hits'] += hits
+
+def count_cache(reader, hit):
+    # Count a cache hit or miss of a cached reader when profiling is on
+    if PROFILE is not None:
+        counts = PROFILE['cache'].setdefault(reader, {'hits': 0, 'misses': 0})
+        counts['hits' if hit else 'misses'] += 1
+
+def report_progress(hits):
+    # Add a batch of compiled hits to the progress counter when profiling is on
+    if PROFILE is not None:
+        PROFILE['hits'] += hits
+        if PROFILE['progress']:
+            print('\rCompiled {} hits'.format(PROFILE['hits']), end='',
+                  file=sys.stderr)
+
+def as_nanoseconds(dates):
+    # Express datetimes as int64 nanoseconds so that hit and practice times
+    # can be compared and searched regardless of their datetime resolution
+    return np.asarray(dates, dtype='datetime64[ns]').view(np.int64)
+
+def get_practice_timeline(practice):
+    """
+    get_practice_timeline takes a practice dataframe, as returned for one
+    player type by read_practice_data, and builds the index the lookup
+    helpers search. It holds sorted int64 nanosecond arrays of the activity
+    boundaries (every practice row) and of the practice days, with the start,
+    end and break time of each day. A day without a break gets a break time
+    after every hit, and a day missing its start or end gets an empty window.
+    The practice rows must be in time order, or a ValueError is raised.
+    """
+    # The lookups binary search the rows, which would silently give the
+    # wrong activity for an unsorted sheet
+    if not practice.date.is_monotonic_increasing:
+        raise ValueError('practice rows are not in time order')
+    day = practice.date.dt.normalize()
+    days = np.unique(as_nanoseconds(day))
+    timeline = {'times': as_nanoseconds(practice.date),
+                'skip': practice.period.isin(['break', 'all up']).values,
+                'days': days}
+    latest = np.iinfo(np.int64).max
+    earliest = np.iinfo(np.int64).min
+    for period, missing in (('start', latest), ('end', earliest), ('break', latest)):
+        mask = (practice.period == period).values
+        times = pd.Series(as_nanoseconds(practice.date[mask]),
+                          index=as_nanoseconds(day[mask]))
+        # Use the first row of each period on a given day
+        timeline[period] = (times.groupby(level=0).first()
+                                 .reindex(days, fill_value=missing).values)
+    return timeline
+
+def build_practice_index(practices):
+    """
+    build_practice_index takes the practices returned by read_practice_data
+    and builds a practice timeline for every player type.
+    """
+    return {ptype: get_practice_timeline(practices[ptype])
+            for ptype in practices}
+
+def get_practice_day_idx(timeline, hit_date):
+    # Find the index of the practice day of the hit, or -1 if there was no
+    # practice on that day
+    when = as_nanoseconds(hit_date)
+    day = when - when % NS_PER_DAY
+    days = timeline['days']
+    day_idx = np.minimum(np.searchsorted(days, day), len(days) - 1)
+    return np.where(days[day_idx] == day, day_idx, -1)[()]
+
 @toolz.curry
-def during_practice(practice, hit_date):
+def during_practice(timeline, hit_date):
     """ 
-    during_practice takes a hit_date that is a datetime object and a pandas
-    dataframe called practices. practices should have a start and end time for
-    the practice session that occurs on a given day.
-    """
-    # Find day of hit and format as a string
-    hit_day = hit_date.date().strftime('%Y-%m-%d')
-    # Find the start and end time of the practice of the hit day
-    start_time = practice[hit_day].loc[practice.period == 'start'].date
-    end_time = practice[hit_day].loc[practice.period == 'end'].date
-    if start_time.empty or end_time.empty:
-        return False
+    during_practice takes a hit_date that is a datetime object (or an array
+    of them) and the practice timeline of the hit player's type. The timeline
+    holds the start and end time of the practice session that occurs on a
+    given day.
+    """
+    day_idx = get_practice_day_idx(timeline, hit_date)
+    start = timeline['start'][np.maximum(day_idx, 0)]
+    end = timeline['end'][np.maximum(day_idx, 0)]
     # determine if the hit occurred during practice
-    return np.logical_and(start_time <= hit_date, hit_date <= end_time).values[0]
+    when = as_nanoseconds(hit_date)
+    return np.logical_and(day_idx >= 0,
+                          np.logical_and(start <= when, when <= end))[()]
 
 @toolz.curry
-def during_event(practices, hit):
-    return during_practice(practices[hit.ptype], hit.date)
+def during_event(practice_index, hit):
+    return during_practice(practice_index[hit.ptype], hit.date)
 
 @toolz.curry
-def before_break(practice, hit_date):
-    # Find day of hit and format as a string
-    hit_day = hit_date.date().strftime('%Y-%m-%d')
-    # Find the start time of the break period
-    break_time = practice[hit_day].loc[practice.period == 'break'].date
-    if break_time.empty:
-        # If the practice session didn't have a break, by definition all events
-        # for that session occurred before the break.
-        return True
-    # determine if the hit occurred during practice
-    return (hit_date <= break_time).values[0]
+def before_break(timeline, hit_date):
+    # Find the start time of the break period. If the practice session didn't
+    # have a break, by definition all events for that session occurred before
+    # the break.
+    day_idx = get_practice_day_idx(timeline, hit_date)
+    break_time = np.where(day_idx >= 0,
+                          timeline['break'][np.maximum(day_idx, 0)],
+                          np.iinfo(np.int64).max)
+    # determine if the hit occurred before the break
+    return (as_nanoseconds(hit_date) <= break_time)[()]
+    
+def file_digest(filename, blocksize=2**20):
+    # Hash the contents of a file so that cache entries follow the data
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def write_cached_frame(df, path):
+    # Arrow can't type object columns that mix strings and numbers (e.g. the
+    # practice period column), so store their values pickled and note which
+    # columns they were in the file metadata.
+    df = df.copy()
+    pickled = [i for i, col in enumerate(df.columns)
+               if df.dtypes.iloc[i] == object and
+               pd.api.types.infer_dtype(df.iloc[:, i], skipna=True).startswith('mixed')]
+    for i in pickled:
+        df.iloc[:, i] = [pickle.dumps(x) for x in df.iloc[:, i]]
+    table = pa.Table.from_pandas(df)
+    metadata = dict(table.schema.metadata or {})
+    metadata[b'ut_hits'] = json.dumps({'pickled': pickled}).encode()
+    pq.write_table(table.replace_schema_metadata(metadata), path)
+
+def read_cached_frame(path):
+    table = pq.read_table(path)
+    df = table.to_pandas()
+    for i in json.loads(table.schema.metadata[b'ut_hits'].decode())['pickled']:
+        df.iloc[:, i] = [pickle.loads(x) for x in df.iloc[:, i]]
+    return df
+
+def cached_reader(reader):
+    """
+    cached_reader wraps a read_* function so that its cleaned output is kept
+    as Parquet files in CACHE_DIR. Entries are keyed by the reader, its
+    arguments, the workbook's path and contents, the reader's source and the
+    pandas and pyarrow versions, so editing a workbook (or the reader)
+    replaces its entry. Readers returning a dict of sheets are
+    stored one file per sheet. Without pyarrow the workbook is always parsed.
+    The wrapped reader's is_cached(filename, ...) tells whether a call would
+    be served from the cache.
+    """
+    # co_code alone misses edits to the reader's constants and defaults
+    version = hashlib.sha1('\n'.join([inspect.getsource(reader), pd.__version__,
+                                      pa.__version__ if pa else '']).encode())
+    
+    @functools.wraps(reader)
+    def read(filename, *args, **kwargs):
+        with profile_stage(reader.__name__):
+            return read_cached(filename, *args, **kwargs)
     
+    def get_entry(filename, args, kwargs):
+        # Name the cache entry (and the prefix of its stale entries) of a
+        # call. Workbooks of the same name in other folders get other
+        # prefixes.
+        call = hashlib.sha1(repr((os.path.abspath(filename), args,
+                                  sorted(kwargs.items()))).encode())
+        prefix = '{}-{}-{}-'.format(reader.__name__, os.path.basename(filename),
+                                    call.hexdigest()[:16])
+        key = hashlib.sha1(file_digest(filename).encode())
+        key.update(version.digest())
+        return prefix, os.path.join(CACHE_DIR, prefix + key.hexdigest())
+    
+    def is_cached(filename, *args, **kwargs):
+        if CACHE_DIR is None or pa is None:
+            return False
+        return os.path.isdir(get_entry(filename, args, kwargs)[1])
+    
+    def read_cached(filename, *args, **kwargs):
+        if CACHE_DIR is None or pa is None:
+            return reader(filename, *args, **kwargs)
+        prefix, entry = get_entry(filename, args, kwargs)
+        count_cache(reader.__name__, os.path.isdir(entry))
+        if os.path.isdir(entry):
+            with open(os.path.join(entry, 'sheets.json')) as f:
+                sheets = json.load(f)
+            if sheets is None:
+                return read_cached_frame(os.path.join(entry, 'frame.parquet'))
+            return {sheet: read_cached_frame(os.path.join(entry, '{}.parquet'.format(i)))
+                    for i, sheet in enumerate(sheets)}
+        result = reader(filename, *args, **kwargs)
+        # Drop stale entries for this workbook (but not the temporary
+        # directories of other processes), then write the new entry to a
+        # temporary directory and move it into place
+        if os.path.isdir(CACHE_DIR):
+            for name in os.listdir(CACHE_DIR):
+                if name.startswith(prefix) and '.' not in name[len(prefix):]:
+                    shutil.rmtree(os.path.join(CACHE_DIR, name), ignore_errors=True)
+        tmp = entry + '.tmp{}'.format(os.getpid())
+        os.makedirs(tmp)
+        if isinstance(result, dict):
+            sheets = list(result)
+            for i, sheet in enumerate(sheets):
+                write_cached_frame(result[sheet], os.path.join(tmp, '{}.parquet'.format(i)))
+        else:
+            sheets = None
+            write_cached_frame(result, os.path.join(tmp, 'frame.parquet'))
+        with open(os.path.join(tmp, 'sheets.json'), 'w') as f:
+            json.dump(sheets, f)
+        os.rename(tmp, entry)
+        return result
+    read.is_cached = is_cached
+    return read
+
+@cached_reader
 def read_hit_data(filename, skiprows=0, sheet='FINAL- bad hits and 1 out',
                   date_column={'date': [1,2]}): 
     df = pd.read_excel(filename, skiprows=skiprows, sheetname=sheet,
@@ -53,12 +326,79 @@ def read_hit_data(filename, skiprows=0, sheet='FINAL- bad hits and 1 out',
     df.set_index('date', inplace=True)
     return df
 
+def combine_date_time(date, time):
+    # Join a date cell and a time cell of the hit export into one datetime
+    if isinstance(time, datetime.datetime):
+        time = time.time()
+    if isinstance(date, datetime.datetime):
+        date = date.date()
+    return datetime.datetime.combine(date, time)
+
+def iter_hit_data(path, chunksize=10000, skiprows=0,
+                  sheet='FINAL- bad hits and 1 out', date_columns=(1, 2)):
+    """
+    iter_hit_data reads hit records in chunks of at most chunksize rows and
+    yields each chunk as a dataframe like the one returned by read_hit_data.
+    path is a hit workbook (read row by row with openpyxl in read-only mode),
+    a CSV or Parquet export with a date column, or a directory of such
+    exports (e.g. one per day), which are read in sorted filename order.
+    """
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if os.path.splitext(name)[1] in ('.xlsx', '.csv', '.parquet'):
+                for chunk in iter_hit_data(os.path.join(path, name), chunksize,
+                                           skiprows, sheet, date_columns):
+                    yield chunk
+    elif path.endswith('.csv'):
+        for chunk in pd.read_csv(path, chunksize=chunksize, parse_dates=['date'],
+                                 index_col='date'):
+            chunk.columns = [col.strip() for col in chunk.columns]
+            yield chunk
+    elif path.endswith('.parquet'):
+        if pa is None:
+            raise ImportError('pyarrow is needed to read {}'.format(path))
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize):
+            chunk = batch.to_pandas()
+            chunk.columns = [col.strip() for col in chunk.columns]
+            # Exports written from a dataframe restore their date index
+            if 'date' in chunk.columns:
+                chunk = chunk.set_index('date')
+            yield chunk
+    else:
+        # openpyxl is only needed to stream workbooks
+        import openpyxl
+        workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        try:
+            rows = workbook[sheet].iter_rows(min_row=skiprows + 1)
+            header = [str(cell.value).strip() for cell in next(rows)]
+            columns = [col for i, col in enumerate(header)
+                       if i not in date_columns]
+            for block in toolz.partition_all(chunksize, rows):
+                # Read-only worksheets may yield ragged rows
+                values = [[cell.value for cell in row][:len(header)] +
+                          [None] * (len(header) - len(row)) for row in block]
+                values = [row for row in values
+                          if any(value is not None for value in row)]
+                if not values:
+                    continue
+                dates = [combine_date_time(*[row[i] for i in date_columns])
+                         for row in values]
+                chunk = pd.DataFrame([[value for i, value in enumerate(row)
+                                       if i not in date_columns]
+                                      for row in values], columns=columns)
+                chunk.index = pd.DatetimeIndex(dates, name='date')
+                yield chunk
+        finally:
+            workbook.close()
+
+@cached_reader
 def read_attendance_data(filename, date_column='date'):
     df = pd.read_excel(filename)
     df.columns = [str(col).strip() for col in df.columns]
     df.set_index(date_column, inplace=True)
     return df
 
+@cached_reader
 def read_practice_data(filename, skiprows=None, date_column='date'):
     df = pd.read_excel(filename, skiprows=skiprows, sheetname=None)
     df['offensive']['day'] = df['offensive']['day'].ffill()
@@ -71,6 +411,7 @@ def read_practice_data(filename, skiprows=None, date_column='date'):
     df['defensive'].index = df['defensive'][date_column]
     return df
 
+@cached_reader
 def read_participation_data(filename, skiprows=None, date_column='date'):
     df = pd.read_excel(filename, skiprows=skiprows, sheetname=None)
     df['offensive']['day'] = df['offensive']['day'].ffill()
@@ -81,18 +422,90 @@ def read_participation_data(filename, skiprows=None, date_column='date'):
     df['defensive'].set_index(date_column, inplace=True)
     return df
     
+@cached_reader
 def read_serial_num_to_position(filename, index_col='number'):
     return pd.read_excel(filename).set_index(index_col)
 
+@cached_reader
 def read_player_types(filename, index_col='type'):
     return pd.read_excel(filename).set_index(index_col)
 
+@cached_reader
 def read_event_types(filename, index_col='date'):
     return pd.read_excel(filename).set_index(index_col)
 
+@cached_reader
 def read_game_durations(filename, index_col=0):
     return pd.read_excel(filename, index_col=index_col, header=[0,1])
 
+def read_durations(filename):
+    return pd.read_csv(filename)
+
+# Reader of each kind of input file
+INPUT_READERS = {'hits': read_hit_data,
+                 'practices': read_practice_data,
+                 'attendance': read_attendance_data,
+                 'event_types': read_event_types,
+                 'psn_to_pcode': read_serial_num_to_position,
+                 'pcode_to_ptype': read_player_types,
+                 'game_duration': read_game_durations,
+                 'durations': read_durations}
+
+def get_input_keys(norm_methods={'compiled_raw': (None, None)}, hits=True):
+    # List the input files compiling for norm_methods reads
+    keys = (['hits'] if hits else []) + ['practices', 'attendance', 'event_types',
+                                         'psn_to_pcode', 'pcode_to_ptype']
+    if any(time_method for _, time_method in norm_methods.values()):
+        keys += ['game_duration', 'durations']
+    return keys
+
+def set_cache_dir(cache_dir):
+    # Pool workers started by spawn or forkserver re-import this module, so
+    # they are given the caller's CACHE_DIR when they start
+    global CACHE_DIR
+    CACHE_DIR = cache_dir
+
+def read_input(key, filename):
+    # Read one input file with its reader
+    return INPUT_READERS[key](filename)
+
+def needs_parsing(key, filename):
+    # Cached readers parse their workbook unless it has a cache entry; the
+    # other readers only read a CSV
+    reader = INPUT_READERS[key]
+    return hasattr(reader, 'is_cached') and not reader.is_cached(filename)
+
+def read_input_files(input_files, keys=None, max_workers=None):
+    """
+    read_input_files reads the input files named by keys (by default every
+    entry of input_files that has a reader in INPUT_READERS; keys missing
+    from input_files are skipped) and returns the same frames as their read_*
+    functions, keyed like input_files. The workbooks that have to be parsed
+    are read concurrently in a pool of max_workers processes (by default one
+    per workbook, up to one per CPU; with one worker no pool is started), so
+    startup takes about as long as the slowest workbook. Cached workbooks
+    are read directly.
+    """
+    if keys is None:
+        keys = [key for key in input_files if key in INPUT_READERS]
+    keys = [key for key in keys if key in input_files]
+    parse = [key for key in keys if needs_parsing(key, input_files[key])]
+    workers = max_workers or min(len(parse), os.cpu_count() or 1)
+    frames = {}
+    if len(parse) > 1 and workers > 1:
+        # openpyxl parsing holds the GIL, so the workbooks are read in
+        # processes; each worker also fills the cache entry of its workbook
+        with concurrent.futures.ProcessPoolExecutor(
+                workers, initializer=set_cache_dir, initargs=(CACHE_DIR,)) as executor:
+            futures = {key: executor.submit(read_input, key, input_files[key])
+                       for key in parse}
+            for key, future in futures.items():
+                frames[key] = future.result()
+    for key in keys:
+        if key not in frames:
+            frames[key] = read_input(key, input_files[key])
+    return frames
+
 @toolz.curry
 def get_player_type(position_type_df, player_code):
     if not player_code in position_type_df.columns:
@@ -112,221 +525,821 @@ def get_player_position(positions, player_number):
 def get_player_position_code(positions, player_number):
     return positions.loc[player_number]['code']
 
+def build_roster(psn_to_pcode, pcode_to_ptype):
+    """
+    build_roster maps every serial number in psn_to_pcode to its player
+    code, position and player type once, as categoricals indexed by serial
+    number. Codes missing from pcode_to_ptype, or without a player type,
+    get a missing ptype; they are only reported if a hit needs them (see
+    lookup_players).
+    """
+    is_type = pcode_to_ptype == True
+    code_ptype = is_type.idxmax().where(is_type.any())
+    codes = psn_to_pcode['code']
+    return pd.DataFrame({'code': codes.astype('category'),
+                         'position': psn_to_pcode['position'].astype('category'),
+                         'ptype': codes.map(code_ptype).astype('category'),
+                         'known': codes.isin(pcode_to_ptype.columns)},
+                        index=psn_to_pcode.index)
+
+def lookup_players(roster, numbers):
+    """
+    lookup_players takes a roster from build_roster and an array of serial
+    numbers and returns the code, position and ptype of each of them, in
+    order, as a dataframe. Unknown serial numbers and player codes raise the
+    same errors as the scalar lookups.
+    """
+    numbers = np.asarray(numbers)
+    roster_idx = roster.index.get_indexer(numbers)
+    if (roster_idx < 0).any():
+        raise KeyError(numbers[roster_idx < 0][0])
+    players = roster.iloc[roster_idx]
+    if not players.known.all():
+        print('Player code not in position type table. Call Seth.')
+        raise KeyError
+    if players.ptype.isnull().any():
+        print('Something went wrong while determining player type (offensive or defensive). Call Seth.')
+        raise RuntimeError
+    return players[['code', 'position', 'ptype']].reset_index(drop=True)
+
 @toolz.curry
 def get_practice(practices, ptype):
     return practices[ptype]
 
-def get_closest_activity_idx(practice, hit_date):
+def get_closest_activity_idx(timeline, hit_date):
     # Find the index of the practice activity during which the hit occurred
-    return practice.index.get_loc(hit_date, method='pad')
+    return np.searchsorted(timeline['times'], as_nanoseconds(hit_date),
+                           side='right') - 1
 
-def get_activity_idx(practice, hit_date):
+def get_activity_idx(timeline, hit_date):
     # Return the activity during which the hit occurred
-    activity_idx = get_closest_activity_idx(practice, hit_date)
-    act_row = practice.iloc[activity_idx]
+    activity_idx = np.maximum(get_closest_activity_idx(timeline, hit_date), 0)
     ## Hits shouldn't occur during breaks or the all up activities. Assign hits
     ## during these activities to the activity immediately prior.
-    if act_row.period == 'break' or act_row.period == 'all up':
-        activity_idx -= 1
-        ## NOTE: I could do the above recursively, which may be more robust but
-        ##       not strictly necessary since I'm basically looking for the 
-        ##       above result.
-        #return get_activity(practice, player_code, hit_date-1)
-    return activity_idx
+    ## NOTE: I could do this recursively, which may be more robust but not
+    ##       strictly necessary since I'm basically looking for the result
+    ##       immediately prior.
+    return np.where(timeline['skip'][activity_idx],
+                    activity_idx - 1, activity_idx)[()]
 
 @toolz.curry    
-def get_activity(practice, pcode, hit_date):
+def get_activity(practice, timeline, pcode, hit_date):
     # Return the activity during which the hit occurred
-    activity_idx = get_activity_idx(practice, hit_date)
-    return practice.loc[practice.index[activity_idx], pcode]
+    activity_idx = get_activity_idx(timeline, hit_date)
+    return practice[pcode].values[activity_idx]
 
-def get_parti(practice, pcode, hit_date):
+def get_parti(practice, timeline, pcode, hit_date):
     # Return the pcodes of the players that were participating in the event
     # in which the hit occurred
-    activity_idx = get_activity_idx(practice, hit_date)
-    activity = get_activity(practice, pcode, hit_date)
+    activity_idx = get_activity_idx(timeline, hit_date)
+    activity = practice[pcode].values[activity_idx]
     return list(practice.columns[practice.iloc[activity_idx] == activity])
 
 @toolz.curry
-def get_practice_name(practice, hit_date):
-    activity_idx = get_activity_idx(practice, hit_date)
-    return practice.loc[practice.index[activity_idx], 'name']
+def get_practice_name(practice, timeline, hit_date):
+    activity_idx = get_activity_idx(timeline, hit_date)
+    return practice['name'].values[activity_idx]
 
 @toolz.curry
 def get_event_type(event_df, hit_date):
     return event_df.loc[hit_date.date()].type
 
+def get_date_idx(df, hit_date, errors='raise'):
+    # Find the first row of a date indexed dataframe (attendance, event types,
+    # game durations) on the day of each hit. Missing days raise a KeyError,
+    # or get -1 if errors is 'ignore'.
+    days, first = np.unique(as_nanoseconds(pd.DatetimeIndex(df.index).normalize()),
+                            return_index=True)
+    hit_days = as_nanoseconds(pd.DatetimeIndex(hit_date).normalize())
+    day_idx = np.searchsorted(days, hit_days)
+    found = day_idx < len(days)
+    found[found] = days[day_idx[found]] == hit_days[found]
+    if not found.all() and errors == 'raise':
+        raise KeyError(pd.DatetimeIndex(hit_date)[~found][0].date())
+    if not len(days):
+        return np.full(len(hit_days), -1)
+    return np.where(found, first[np.minimum(day_idx, len(days) - 1)], -1)
+
+def build_participation(practices, attendance_df, pcode_to_ptype):
+    """
+    build_participation works out, for every practice row and player code,
+    which player codes took part in that code's activity and how many
+    players they were. For each player type it returns the player codes
+    (the practice columns of that type) and:
+        'members':   a (rows, codes, codes) boolean array, True where the
+                     second code did the same activity as the first
+        'headcount': a (rows, codes) array of the attendance of the member
+                     codes on the row's day, summed (NaN without attendance)
+    """
+    participation = {}
+    for ptype, practice in practices.items():
+        codes = [code for code in pcode_to_ptype.columns
+                 if pcode_to_ptype.loc[ptype, code] == True and code in practice.columns]
+        activities = practice[codes].values
+        members = activities[:, :, np.newaxis] == activities[:, np.newaxis, :]
+        day_idx = get_date_idx(attendance_df, practice.date, errors='ignore')
+        attendance = np.full(activities.shape, np.nan)
+        attendance[day_idx >= 0] = attendance_df[codes].values[day_idx[day_idx >= 0]]
+        participation[ptype] = {
+            'codes': pd.Index(codes),
+            'members': members,
+            'headcount': np.where(members, attendance[:, np.newaxis, :], 0).sum(axis=2)}
+    return participation
+
 def get_num_players(method='by_position', data={}):
+    """
+    get_num_players returns the number of players to normalize each hit by.
+    data holds the attendance dataframe, the participation headcounts and,
+    for every hit, its date, player code, player type and practice row (see
+    compile_hits).
+    """
     att_df = data['attendance_df']
     pcode = data['pcode']
-    hit_date = data['hit_date']
+    day_idx = get_date_idx(att_df, data['hit_date'])
     # Look up number of players
     if method == 'by_position':
         # How many people were playing this position on the hit date?
-        return att_df.loc[hit_date.date()][pcode]
+        num_players = np.empty(len(pcode))
+        for code, idx in pd.Series(pcode).groupby(pcode).indices.items():
+            num_players[idx] = att_df[code].values[day_idx[idx]]
+        return num_players
     elif method == 'total':
         # How many total people were participating on the hit date?
-        att_df = data['df']
-        return att_df.loc[hit_date.date()]['total']
+        return att_df['total'].values[day_idx]
     elif method == 'by_activity':
         # How many people were participating in the activity on the hit date?
-        # What player codes participated in the activity?
-        parti_codes = get_parti(data['practice_df'], pcode, hit_date)
-        return att_df.loc[hit_date.date()][parti_codes].sum()
+        # Look up each hit's practice row and player code in the
+        # participation headcounts (see build_participation).
+        num_players = np.empty(len(pcode))
+        ptype = np.asarray(data['ptype'])
+        for player_type, idx in pd.Series(ptype).groupby(ptype).indices.items():
+            participation = data['participation'][player_type]
+            code_idx = participation['codes'].get_indexer(np.asarray(pcode)[idx])
+            if (code_idx < 0).any():
+                raise KeyError(np.asarray(pcode)[idx][code_idx < 0][0])
+            num_players[idx] = participation['headcount'][np.asarray(data['row'])[idx],
+                                                          code_idx]
+        return num_players
     else:
         raise NotImplementedError
 
-def get_duration(data={}):
-    if data['event_type'] == 'game':
-        hit_date = data['hit_date']
-        game_dur_df = data['game_dur_df']
-        ptype = data['ptype']
-        activity = data['activity']
-        date_mask = [dd.date() == hit_date.date() for dd in game_dur_df.index]
-        return game_dur_df.loc[date_mask, (ptype, activity)].iloc[0]
+def build_duration_index(durations=None, game_dur_df=None, activity_durs=None):
+    """
+    build_duration_index stacks the duration tables into one dict of
+    duration series, keyed for joining against hits:
+        'practice': (day, event, prebreak, ptype), from a table like the one
+                    returned by get_practice_times_pre_post or durations.csv
+        'game':     (day, ptype, activity), from read_game_durations
+        'activity': (event, ptype, activity), from get_activity_durations
+    Days are int64 nanoseconds. The index levels are named as above.
+    Missing tables give empty series and missing durations are left out.
+    Where a key repeats, its first duration is used.
+    """
+    index = {}
+    if durations is not None:
+        practice = (durations.assign(day=as_nanoseconds(pd.to_datetime(durations.day)))
+                             .set_index(['day', 'name', 'prebreak'])
+                             [[col for col in ('offensive', 'defensive')
+                               if col in durations.columns]]
+                             .stack())
     else:
-        durs = data['durations']
-        event = data['event']
-        prebrk = data['prebreak']
-        return durs[np.logical_and(durs.prebreak == prebrk,
-                                   durs.name == event)].length.values[0]
-
-def normalize_hits(hit, player_method=None, time_method=None, data={}):
-    hit = copy.deepcopy(hit).astype(np.float64)
-    if player_method:
-        hit = norm_by_players(hit, method=player_method, data=data)
-    if time_method:
-        hit = norm_by_time(hit, data=data)
-    return hit
-
-def norm_by_players(hit, **kwargs):
-    num_players = get_num_players(**kwargs)
-    if num_players == 0:
-        #hit['sum 1'] = np.NAN
-        hit['sum 2'] = np.NAN
-        hit['sum 3'] = np.NAN
-        hit['sum 4'] = np.NAN
-        hit['sum 5'] = np.NAN
+        practice = pd.Series([], index=pd.MultiIndex.from_arrays([[]] * 4), dtype=np.float64)
+    index['practice'] = practice
+    if game_dur_df is not None:
+        game = game_dur_df.set_axis(as_nanoseconds(pd.DatetimeIndex(game_dur_df.index).normalize()),
+                                    axis=0).stack(level=[0, 1])
+    else:
+        game = pd.Series([], index=pd.MultiIndex.from_arrays([[]] * 3), dtype=np.float64)
+    index['game'] = game
+    if activity_durs is not None:
+        activity = activity_durs.stack(level=[0, 1])
     else:
-        #hit['sum 1'] /= num_players
-        hit['sum 2'] /= num_players
-        hit['sum 3'] /= num_players
-        hit['sum 4'] /= num_players
-        hit['sum 5'] /= num_players
-    return hit
-
-def norm_by_time(hit, **kwargs):
-    duration = get_duration(**kwargs)
-    if duration == 0:
-        #hit['sum 1'] = np.NAN
-        hit['sum 2'] = np.NAN
-        hit['sum 3'] = np.NAN
-        hit['sum 4'] = np.NAN
-        hit['sum 5'] = np.NAN
+        activity = pd.Series([], index=pd.MultiIndex.from_arrays([[]] * 3), dtype=np.float64)
+    index['activity'] = activity
+    levels = {'practice': ['day', 'event', 'prebreak', 'ptype'],
+              'game': ['day', 'ptype', 'activity'],
+              'activity': ['event', 'ptype', 'activity']}
+    return {key: pd.to_numeric(series[~series.index.duplicated()].dropna())
+                   .rename_axis(levels[key])
+            for key, series in index.items()}
+
+def lookup_durations(durations, keys, missing='raise'):
+    """
+    lookup_durations joins an array of keys per index level against a
+    duration series from build_duration_index. A key without a duration
+    raises a KeyError naming it (with its day as a date), or gives NaN with
+    missing='nan'.
+    """
+    dur_idx = durations.index.get_indexer(pd.MultiIndex.from_arrays(keys))
+    found = dur_idx >= 0
+    if not found.all() and missing == 'raise':
+        key = [np.asarray(values)[~found][:1].tolist()[0] for values in keys]
+        raise KeyError(tuple(str(pd.Timestamp(value).date()) if level == 'day'
+                             else value
+                             for level, value in zip(durations.index.names, key)))
+    result = np.full(len(dur_idx), np.nan)
+    result[found] = durations.values[dur_idx[found]]
+    return result
+
+def get_duration(method='by_time', data={}):
+    """
+    get_duration returns the duration to normalize each hit by, looked up in
+    data['duration_index'] (see build_duration_index). Game hits use the
+    game duration of the hit's activity for its player type. With the
+    'by_time' method other hits use the length of their practice before or
+    after the break for their player type; with 'by_activity_time' they use
+    the length of their activity in that practice. Activities without a
+    length, such as the 'post' activity of a hit at the very end of a
+    practice, give NaN.
+    """
+    index = data['duration_index']
+    event_type = np.asarray(data['event_type'])
+    ptype = np.asarray(data['ptype'])
+    event = np.asarray(data['event'])
+    activity = np.asarray(data['activity'])
+    days = as_nanoseconds(pd.DatetimeIndex(data['hit_date']).normalize())
+    durations = np.empty(len(event_type))
+    game = event_type == 'game'
+    practice = ~game
+    if game.any():
+        durations[game] = lookup_durations(index['game'],
+                                           [days[game], ptype[game], activity[game]])
+    if not practice.any():
+        return durations
+    if method == 'by_time':
+        durations[practice] = lookup_durations(
+            index['practice'], [days[practice], event[practice],
+                                np.asarray(data['prebreak'])[practice],
+                                ptype[practice]])
+    elif method == 'by_activity_time':
+        durations[practice] = lookup_durations(
+            index['activity'], [event[practice], ptype[practice],
+                                activity[practice]], missing='nan')
     else:
-        #hit['sum 1'] /= duration
-        hit['sum 2'] /= duration
-        hit['sum 3'] /= duration
-        hit['sum 4'] /= duration
-        hit['sum 5'] /= duration
-    return hit
-
-def get_hits_out_of_event(input_files):    
-    practices = read_practice_data(input_files['practices'])
-    psn_to_pcode = read_serial_num_to_position(input_files['psn_to_pcode'])
-    pcode_to_ptype = read_player_types(input_files['pcode_to_ptype'])
+        raise NotImplementedError
+    return durations
+
+def get_hit_sums(hits):
+    # Copy the HIT_SUMS of a dataframe of hits into a contiguous float64
+    # array with one row per hit
+    return np.ascontiguousarray(hits[HIT_SUMS].values, dtype=np.float64)
+
+def divide_sums(sums, denominator):
+    # Divide every row of sums in place by its denominator, leaving NaN
+    # wherever the denominator is zero
+    denominator = np.asarray(denominator, dtype=np.float64)
+    zero = denominator == 0
+    np.divide(sums, denominator[:, np.newaxis], out=sums,
+              where=~zero[:, np.newaxis])
+    sums[zero] = np.nan
+    return sums
+
+def normalize_sums(sums, num_players=None, durations=None, out=None):
+    """
+    normalize_sums takes a float64 array of hit sums (one row per hit, as
+    returned by get_hit_sums) and divides each row by the hit's number of
+    players and/or duration, given as arrays with one value per hit. Rows
+    with a zero denominator become NaN. The result is written to out, which
+    may be sums itself; by default a new array is returned.
+    """
+    if out is None:
+        out = np.array(sums, dtype=np.float64)
+    elif out is not sums:
+        np.copyto(out, sums)
+    for denominator in (num_players, durations):
+        if denominator is not None:
+            divide_sums(out, denominator)
+    return out
+
+def normalize_hits(hits, player_method=None, time_method=None, data={}):
+    """
+    normalize_hits takes a dataframe of hits and returns their HIT_SUMS as
+    a float64 array divided by the number of players and/or the duration of
+    the event. data describes every hit (see compile_all).
+    """
+    sums = get_hit_sums(hits)
+    if player_method:
+        sums = norm_by_players(sums, method=player_method, data=data)
+    if time_method:
+        sums = norm_by_time(sums, method=time_method, data=data)
+    return sums
+
+def norm_by_players(sums, **kwargs):
+    return divide_sums(sums, get_num_players(**kwargs))
+
+def norm_by_time(sums, **kwargs):
+    return divide_sums(sums, get_duration(**kwargs))
+
+def get_hits_out_of_event(input_files, output='hits_not_during_events.csv',
+                          manifest_path=None):
+    """
+    get_hits_out_of_event writes the hits that didn't occur during a
+    practice period or game to output. With a manifest_path, only the days
+    whose hits or practices changed since the last run are redone and
+    spliced into the existing output (see get_stale_days).
+    """
+    frames = read_input_files(input_files, ['practices', 'psn_to_pcode',
+                                            'pcode_to_ptype', 'hits'])
+    practices = frames['practices']
+    psn_to_pcode = frames['psn_to_pcode']
+    pcode_to_ptype = frames['pcode_to_ptype']
+    hits = frames['hits']
+    
+    stale_days = None
+    if manifest_path:
+        manifest = {'global': hash_frames([psn_to_pcode, pcode_to_ptype]),
+                    'days': get_day_hashes([hits] + [practices[p] for p in sorted(practices)])}
+        stale_days = get_stale_days(manifest_path, manifest, [output])
+        if stale_days is not None:
+            hits = hits[day_strings(hits.index).isin(stale_days).values]
     
-    de = during_event(practices)
-    psn_to_ptype = toolz.compose(get_player_type(pcode_to_ptype),
-                                 get_player_position_code(psn_to_pcode))
+    practice_index = build_practice_index(practices)
+    roster = build_roster(psn_to_pcode, pcode_to_ptype)
     
-    hits = (read_hit_data(input_files['hits'])
-             .reset_index()
-             .assign(ptype=lambda x: x.Number.apply(psn_to_ptype))
-             .assign(in_event=lambda x: x.apply(de, axis=1)))
+    # Check the hits of each player type against its practice windows at
+    # once. No stale day may have hits, e.g. on a rerun with unchanged
+    # inputs; the stale days are still spliced out of the output.
+    hits = hits.reset_index()
+    ptype = np.asarray(lookup_players(roster, hits.Number).ptype)
+    in_event = np.zeros(len(hits), dtype=bool)
+    for player_type, idx in pd.Series(ptype).groupby(ptype).indices.items():
+        in_event[idx] = during_practice(practice_index[player_type],
+                                        hits.date.values[idx])
+    hits = hits.assign(ptype=ptype, in_event=in_event)
     hits = hits.drop(hits.columns[range(2, 22)], axis=1)
-    hits[hits.in_event == False].to_csv('hits_not_during_events.csv')
+    if stale_days is None:
+        hits[hits.in_event == False].to_csv(output)
+    else:
+        hits.index += get_next_label(output)
+        splice_output(output, hits[hits.in_event == False], stale_days, by=None)
+    if manifest_path:
+        write_manifest(manifest_path, manifest)
     
 def get_practice_times_pre_post(practices):
-    # Just select the offensive practices - they should be the same
+    """
+    get_practice_times_pre_post returns the length of every practice before
+    and after its break for each player type, in the layout of
+    durations.csv: name, prebreak and day columns plus one length column per
+    player type. Every practice row is labelled pre or post by joining it
+    with the break time of its day, and the lengths of all player types are
+    summed in one groupby.
+    """
+    segments = []
     for p in practices:
         practice = practices[p]
-        practice['day'] = [pd.to_datetime(x).date() for x in practice['date']]
-        practice['prebreak'] = ['pre' if before_break(practice, x['date'])
-                                else 'post'
-                                for idx, x in practice.iterrows()]
-        (practice.groupby(['name', 'prebreak', 'day'], as_index=False)
-            .sum()
-            .sort_values(by=['day', 'name', 'prebreak'])
-            .to_csv('{}_practice_lengths.csv'.format(p), index=False))
+        timeline = get_practice_timeline(practice)
+        segments.append(pd.DataFrame({
+            'name': practice['name'].values,
+            'prebreak': np.where(before_break(timeline, practice['date'].values),
+                                 'pre', 'post'),
+            'day': practice['date'].dt.date.values,
+            'ptype': p,
+            'length': pd.to_numeric(practice['length'], errors='coerce').values}))
+    lengths = (pd.concat(segments, ignore_index=True)
+                 .groupby(['name', 'prebreak', 'day', 'ptype'])['length']
+                 .sum()
+                 .unstack('ptype')
+                 .reindex(columns=list(practices)))
+    lengths.columns.name = None
+    return (lengths
+              .reset_index()
+              .sort_values(by=['day', 'name', 'prebreak']))
             
+def resolve_hit_context(hits, practices, practice_index, roster):
+    """
+    resolve_hit_context assigns every hit its player code, player type,
+    practice window, activity row and break side in one pass. hits is the
+    dataframe returned by read_hit_data, practice_index is built from
+    practices by build_practice_index and roster is built by build_roster.
+    The returned dataframe is aligned with
+    hits (same order, numbered from zero). Rows where in_practice is False
+    did not occur during a practice period and their remaining columns are
+    meaningless.
+    """
+    hit_dates = as_nanoseconds(hits.index)
+    with profile_stage('position lookup', len(hits)):
+        players = lookup_players(roster, hits.Number)
+    ctx = pd.DataFrame({'pcode': np.asarray(players.code),
+                        'ptype': np.asarray(players.ptype),
+                        'player': np.asarray(players.position),
+                        'in_practice': False,
+                        'row': -1,
+                        'event': None,
+                        'activity': None,
+                        'before_break': None})
+    col = ctx.columns.get_loc
+    for player_type, idx in ctx.groupby('ptype').indices.items():
+        practice = practices[player_type]
+        timeline = practice_index[player_type]
+        when = hit_dates[idx]
+        with profile_stage('during_practice', len(idx)):
+            ctx.iloc[idx, col('in_practice')] = during_practice(timeline, when)
+        with profile_stage('activity resolution', len(idx)):
+            activity_idx = get_activity_idx(timeline, when)
+            ctx.iloc[idx, col('row')] = activity_idx
+            ctx.iloc[idx, col('event')] = practice['name'].values[activity_idx]
+            # Read the activity of each hit player's position code
+            for pcode, pidx in ctx.iloc[idx].groupby('pcode').indices.items():
+                ctx.iloc[idx[pidx], col('activity')] = practice[pcode].values[activity_idx[pidx]]
+        with profile_stage('before_break', len(idx)):
+            ctx.iloc[idx, col('before_break')] = np.where(before_break(timeline, when),
+                                                          'pre', 'post')
+    return ctx
+
+def get_event_types(event_df, hit_dates):
+    # Look up the event type of every hit's day at once
+    return event_df.type.values[get_date_idx(event_df, hit_dates)]
+
+def as_typed(results):
+    # Store the string columns of compiled hit data as categoricals, e.g.
+    # after concatenating results whose categories differ
+    return results.astype({col: 'category' for col in CATEGORICAL_COLUMNS})
+
+def sort_by_date(results, by='date'):
+    # Sort compiled hits by date, breaking ties by label, so that full,
+    # parallel and incremental compiles order the hits alike
+    return results.iloc[np.lexsort((results.index.values, results[by].values))]
+
+def build_results(hit_dates, ctx, sums, labels):
+    """
+    build_results assembles the compiled dataframe from the hit context and
+    the normalized hit sums, numbering the hits with labels. The string
+    columns are categoricals, h2-h5 are float64 and day is the hit date at
+    midnight, so the CSV output reads as before.
+    """
+    hit_dates = pd.DatetimeIndex(hit_dates)
+    results = pd.DataFrame({'activity': pd.Categorical(ctx.activity.values),
+                            'before_break': pd.Categorical(ctx.before_break.values),
+                            'date': hit_dates,
+                            'event': pd.Categorical(ctx.event.values),
+                            'h2': sums[:, 0],
+                            'h3': sums[:, 1],
+                            'h4': sums[:, 2],
+                            'h5': sums[:, 3],
+                            'pcode': pd.Categorical(ctx.pcode.values),
+                            'player': pd.Categorical(ctx.player.values),
+                            'ptype': pd.Categorical(ctx.ptype.values),
+                            'type': pd.Categorical(ctx.event_type.values),
+                            'day': hit_dates.normalize()},
+                           columns=['activity', 'before_break', 'date',
+                                    'event', 'h2', 'h3', 'h4', 'h5', 'pcode',
+                                    'player', 'ptype', 'type', 'day'],
+                           index=labels)
+    return sort_by_date(results)
+
+def read_tables(input_files, norm_methods={'compiled_raw': (None, None)},
+                frames=None):
+    """
+    read_tables reads every input file except the hits (see
+    read_input_files), unless frames already holds them, and returns the
+    tables compile_hits needs as a dict. For time normalization, practice
+    durations are read from the 'durations' input file if there is one and
+    otherwise computed from the practices, activity durations are computed
+    from the practices and game durations are read from the
+    'game_duration' input file.
+    """
+    if frames is None:
+        frames = read_input_files(input_files, get_input_keys(norm_methods, hits=False))
+    practices = frames['practices']
+    tables = {'practices': practices,
+              'practice_index': build_practice_index(practices),
+              'attendance_df': frames['attendance'],
+              #'parti': read_participation_data(input_files['participation']),
+              'event_df': frames['event_types'],
+              'psn_to_pcode': frames['psn_to_pcode'],
+              'pcode_to_ptype': frames['pcode_to_ptype'],
+              'game_dur_df': None,
+              'durations': None,
+              'activity_durs': None,
+              'duration_index': None}
+    tables['roster'] = build_roster(tables['psn_to_pcode'], tables['pcode_to_ptype'])
+    tables['participation'] = build_participation(practices, tables['attendance_df'],
+                                                  tables['pcode_to_ptype'])
+    if any(time_method for _, time_method in norm_methods.values()):
+        if 'game_duration' in input_files:
+            tables['game_dur_df'] = frames['game_duration']
+        if 'durations' in input_files:
+            tables['durations'] = frames['durations']
+        else:
+            tables['durations'] = get_practice_times_pre_post(practices)
+        tables['activity_durs'] = get_activity_durations(practices)
+        tables['duration_index'] = build_duration_index(tables['durations'],
+                                                        tables['game_dur_df'],
+                                                        tables['activity_durs'])
+    return tables
+
+def compile_hits(hits, tables, norm_methods={'compiled_raw': (None, None)},
+                 first_index=0, labels=None):
+    """
+    compile_hits resolves the context of a batch of hits once and then
+    compiles one dataframe for each entry of norm_methods, which maps an
+    output name to the (player_method, time_method) pair passed to
+    normalize_hits. hits is a dataframe like the one returned by
+    read_hit_data and tables is returned by read_tables. The hits that
+    occurred during a practice period are numbered from first_index, unless
+    labels gives the number of every hit in the batch.
+    """
+    # Resolve every hit's practice context at once and drop the hits that
+    # didn't occur during a practice period
+    ctx = resolve_hit_context(hits, tables['practices'],
+                              tables['practice_index'], tables['roster'])
+    in_practice = ctx.in_practice.values
+    hits = hits[in_practice]
+    ctx = ctx[in_practice].reset_index(drop=True)
+    with profile_stage('event type lookup', len(hits)):
+        ctx['event_type'] = get_event_types(tables['event_df'], hits.index)
+    if labels is None:
+        labels = np.arange(first_index, first_index + len(ctx))
+    else:
+        labels = np.asarray(labels)[in_practice]
+    
+    # Normalize the hit data for each output
+    data = dict(tables,
+                hit_date=hits.index,
+                pcode=ctx.pcode.values,
+                ptype=ctx.ptype.values,
+                row=ctx.row.values,
+                event=ctx.event.values,
+                event_type=ctx.event_type.values,
+                activity=ctx.activity.values,
+                prebreak=ctx.before_break.values)
+    # Each denominator is computed once, however many outputs use it. Each
+    # stage is entered once per batch so that its hits are counted once.
+    with profile_stage('denominators', len(hits)):
+        sums = get_hit_sums(hits)
+        num_players = {method: get_num_players(method, data)
+                       for method, _ in norm_methods.values() if method}
+        durations = {method: get_duration(method, data)
+                     for _, method in norm_methods.values() if method}
+    with profile_stage('normalization', len(hits)):
+        normalized = {name: normalize_sums(sums, num_players=num_players.get(player_method),
+                                           durations=durations.get(time_method))
+                      for name, (player_method, time_method) in norm_methods.items()}
+    with profile_stage('result assembly', len(hits)):
+        results = {name: build_results(hits.index, ctx, normalized[name], labels)
+                   for name in norm_methods}
+    report_progress(len(hits))
+    return results
+
+def compile_all(input_files, norm_methods={'compiled_raw': (None, None)}):
+    """
+    compile_all reads the input files (concurrently, see read_input_files)
+    and compiles every hit once for all of norm_methods (see compile_hits).
+    """
+    frames = read_input_files(input_files, get_input_keys(norm_methods))
+    tables = read_tables(input_files, norm_methods, frames)
+    hits = frames['hits']
+    return compile_hits(hits, tables, norm_methods)
+
 def compile_data(input_files, norm_methods=(None, None)):
-    hits = read_hit_data(input_files['hits'])
-    practices = read_practice_data(input_files['practices'])
-    att = read_attendance_data(input_files['attendance'])
-    #game_dur = read_game_durations(input_files['game_duration'])
-    #duration_data = pd.read_csv('practice_lengths.csv')
-    #parti = read_participation_data(input_files['participation'])
-    event_df = read_event_types(input_files['event_types'])
-    psn_to_pcode = read_serial_num_to_position(input_files['psn_to_pcode'])
-    pcode_to_ptype = read_player_types(input_files['pcode_to_ptype'])
+    return compile_all(input_files, {'compiled': norm_methods})['compiled']
+
+def compile_stream(input_files, norm_methods={'compiled_raw': (None, None)},
+                   chunksize=10000, output_pattern='{}.csv'):
+    """
+    compile_stream compiles the hits in chunks of at most chunksize rows
+    (see iter_hit_data) and appends each chunk's results to one CSV per
+    output name, so memory stays bounded however large the hit export is.
+    Hits are numbered across chunks as compile_all numbers them. Each chunk
+    is sorted by date, so the output is only sorted overall if the hits
+    are, e.g. when reading day-partitioned exports. Returns the number of
+    hits written to each output.
+    """
+    tables = read_tables(input_files, norm_methods)
+    counts = dict.fromkeys(norm_methods, 0)
+    first_index = 0
+    chunks = iter_hit_data(input_files['hits'], chunksize=chunksize)
+    for i, hits in enumerate(chunks):
+        results = compile_hits(hits, tables, norm_methods, first_index)
+        for name, compiled in results.items():
+            compiled.to_csv(output_pattern.format(name),
+                            mode='a' if i else 'w', header=not i)
+            counts[name] += len(compiled)
+        first_index += len(compiled)
+    return counts
     
-    results = []
-    for hit_date, hit in hits.iterrows():
-        # Look up the hit player's position code
-        pcode = get_player_position_code(psn_to_pcode, hit.Number)
-        # Determine the player type
-        player_type = get_player_type(pcode_to_ptype, pcode)
-        # Load the correct set of practices
-        practice = practices[player_type]
-        # Filter the hit out if it doesn't occur during a practice period
-        if not during_practice(practice, hit_date):
-            continue
-        # Look up the hit player's position
-        player_position = get_player_position(psn_to_pcode, hit.Number)
-        # Look up the event
-        event = get_practice_name(practice, hit_date)
-        # Look up the event type
-        event_type = get_event_type(event_df, hit_date)
-        # Look up the activity
-        activity = get_activity(practice, pcode, hit_date)
-        # Determine pre/post break
-        prebreak = 'pre' if before_break(practice, hit_date) else 'post'
-        # Normalize the hit data
-        data = {'attendance_df': att,
-                'practice_df': practice,
-                #'game_dur_df': game_dur,
-                'pcode': pcode,
-                'ptype': player_type,
-                'event': event,
-                'event_type': event_type,
-                'activity': activity,
-                'hit': hit,
-                'hit_date': hit_date,
-                #'durations': duration_data,
-                'prebreak': prebreak}
-        hit = normalize_hits(hit, *norm_methods, data)
-            
-        print('Processing hit...\n'+
-              '\tHit Date: {}\n'.format(hit_date))
-        
-        # Add results to list
-        results.append({'event': event,
-                        'type': event_type,
-                        'date': hit_date,
-                        'activity': activity,
-                        'before_break': prebreak,
-                        'player': player_position,
-                        'pcode': pcode,
-                        'ptype': player_type,
-                        #'h1': hit['sum 1'], 
-                        'h2': hit['sum 2'], 
-                        'h3': hit['sum 3'], 
-                        'h4': hit['sum 4'],
-                        'h5': hit['sum 5']})        
-    return (pd.DataFrame(results)
-              .assign(day=lambda x: [pd.to_datetime(y).date() for y in x.date])
-              .sort_values(by=['date']))
+def split_by_day(df):
+    # Split a dataframe indexed by date or datetime into one dataframe per
+    # day, keyed by the day as int64 nanoseconds
+    days = as_nanoseconds(pd.DatetimeIndex(df.index).normalize())
+    return {day: df.iloc[idx] for day, idx in pd.Series(days).groupby(days).indices.items()}
+
+def get_day_ranges(days, n_ranges):
+    """
+    get_day_ranges cuts the timeline at day boundaries into at most n_ranges
+    contiguous [start, stop) ranges of int64 nanosecond days holding about
+    the same number of the given days (one per hit). The first range starts
+    and the last one stops at the ends of the int64 range, so together they
+    cover every day.
+    """
+    unique_days, counts = np.unique(days, return_counts=True)
+    cuts = np.searchsorted(np.cumsum(counts),
+                           len(days) * np.arange(1, n_ranges) / n_ranges,
+                           side='right')
+    edges = np.unique(unique_days[cuts[cuts < len(unique_days)]])
+    edges = edges[edges > unique_days[0]] if len(unique_days) else edges
+    bounds = ([np.iinfo(np.int64).min] + edges.tolist() +
+              [np.iinfo(np.int64).max])
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def in_day_range(dates, day_range):
+    # Tell which dates fall on a day of a [start, stop) range of days
+    days = as_nanoseconds(pd.DatetimeIndex(dates).normalize())
+    return (day_range[0] <= days) & (days < day_range[1])
+
+def slice_tables(tables, day_range):
+    """
+    slice_tables returns the tables (see read_tables) restricted to the days
+    of day_range: the practices, attendance, event types, practice and game
+    durations of those days and the activity durations of their practices.
+    The practice timelines, participation and duration index are rebuilt
+    from the slices.
+    """
+    practices = {player_type: practice[in_day_range(practice.date, day_range)]
+                 for player_type, practice in tables['practices'].items()}
+    sliced = dict(tables,
+                  practices=practices,
+                  practice_index=build_practice_index(practices))
+    for name in ('attendance_df', 'event_df', 'game_dur_df'):
+        if tables[name] is not None:
+            sliced[name] = tables[name][in_day_range(tables[name].index, day_range)]
+    sliced['participation'] = build_participation(practices, sliced['attendance_df'],
+                                                  tables['pcode_to_ptype'])
+    if tables['duration_index'] is not None:
+        durations = tables['durations']
+        sliced['durations'] = durations[in_day_range(pd.to_datetime(durations.day),
+                                                     day_range)]
+        names = set().union(*[practice['name'] for practice in practices.values()])
+        activity_durs = tables['activity_durs']
+        sliced['activity_durs'] = activity_durs[activity_durs.index.isin(names)]
+        sliced['duration_index'] = build_duration_index(sliced['durations'],
+                                                        sliced['game_dur_df'],
+                                                        sliced['activity_durs'])
+    return sliced
+
+def get_shards(hits, tables, norm_methods, n_shards):
+    """
+    get_shards splits the hits into at most n_shards independent shards of
+    contiguous days, cut only at day boundaries and holding about the same
+    number of hits. Each shard carries the slices of the tables for its days
+    (see slice_tables) and only the hit columns compile_hits reads. Every
+    hit keeps its position in hits as its label.
+    """
+    days = as_nanoseconds(pd.DatetimeIndex(hits.index).normalize())
+    # Only ship the hit columns compile_hits reads
+    hits = hits[['Number'] + HIT_SUMS]
+    shards = []
+    for day_range in get_day_ranges(days, n_shards):
+        idx = np.flatnonzero((day_range[0] <= days) & (days < day_range[1]))
+        if len(idx):
+            shards.append((hits.iloc[idx], slice_tables(tables, day_range),
+                           norm_methods, idx))
+    return shards
+
+def compile_shard(shard):
+    hits, tables, norm_methods, labels = shard
+    return compile_hits(hits, tables, norm_methods, labels=labels)
+
+def compile_parallel(input_files, norm_methods={'compiled_raw': (None, None)},
+                     max_workers=None):
+    """
+    compile_parallel compiles the hits like compile_all, but splits them into
+    one shard of contiguous days per worker (see get_shards) and compiles
+    the shards in a pool of max_workers processes (by default one per CPU;
+    with one worker the hits are compiled in this process like compile_all
+    does). The merged results match compile_all's.
+    """
+    frames = read_input_files(input_files, get_input_keys(norm_methods))
+    tables = read_tables(input_files, norm_methods, frames)
+    hits = frames['hits']
+    workers = max_workers or os.cpu_count() or 1
+    shards = get_shards(hits, tables, norm_methods, workers) if workers > 1 else []
+    if len(shards) < 2:
+        return compile_hits(hits, tables, norm_methods)
+    with concurrent.futures.ProcessPoolExecutor(min(workers, len(shards))) as executor:
+        compiled = list(executor.map(compile_shard, shards))
+    # Put the hits back in their original order, number them as compile_all
+    # does and sort them by date
+    results = {}
+    for name in norm_methods:
+        merged = as_typed(pd.concat([shard[name] for shard in compiled]).sort_index())
+        merged.index = np.arange(len(merged))
+        results[name] = sort_by_date(merged)
+    return results
+    
+def day_strings(dates):
+    # Format dates as the day keys used in manifests and compiled outputs
+    return pd.Series(pd.DatetimeIndex(dates).strftime('%Y-%m-%d'))
+
+def hash_frames(frames):
+    # Hash the contents of a list of dataframes (None for a missing table)
+    digest = hashlib.sha1()
+    for df in frames:
+        if df is not None:
+            digest.update(repr(list(df.columns)).encode())
+            digest.update(pd.util.hash_pandas_object(df).values.tobytes())
+        digest.update(b'|')
+    return digest.hexdigest()
+
+def get_day_hashes(frames):
+    """
+    get_day_hashes takes a list of dataframes indexed by date or datetime and
+    returns a dict mapping each day to a hash of the rows of every dataframe
+    on that day.
+    """
+    by_day = [split_by_day(df) if df is not None else {} for df in frames]
+    days = sorted(set().union(*by_day))
+    return {day_strings([day])[0]: hash_frames([slices.get(day) for slices in by_day])
+            for day in days}
+
+def read_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return {'global': None, 'days': {}}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+def write_manifest(manifest_path, manifest):
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+def get_stale_days(manifest_path, manifest, outputs):
+    """
+    get_stale_days compares a manifest of the current inputs (a 'global'
+    hash of the tables that affect every day and a hash per day) with the
+    one saved at manifest_path by the last run. It returns the days that
+    are new, changed or gone, or None if everything has to be redone
+    because the global hash changed or an output is missing.
+    """
+    previous = read_manifest(manifest_path)
+    if (previous['global'] != manifest['global'] or
+            not all(os.path.exists(output) for output in outputs)):
+        return None
+    days = manifest['days']
+    return sorted(day for day in set(days) | set(previous['days'])
+                  if days.get(day) != previous['days'].get(day))
+
+def get_next_label(output):
+    # Find the label after the largest one in an output CSV, so that spliced
+    # rows don't reuse the labels of the rows already there
+    labels = pd.read_csv(output, usecols=[0]).iloc[:, 0]
+    return int(labels.max()) + 1 if len(labels) else 0
+
+def splice_output(output, df, stale_days, by='date'):
+    """
+    splice_output replaces the rows of an output CSV that fall on one of the
+    stale_days with the rows of df, then sorts the rows by the given column
+    and label (or by label if by is None) and writes the result back.
+    """
+    old = pd.read_csv(output, index_col=0, parse_dates=['date'])
+    if 'day' in old:
+        old['day'] = pd.to_datetime(old['day'])
+    old = old[~day_strings(old.date).isin(stale_days).values]
+    spliced = pd.concat([old, df])
+    if by is None:
+        spliced = spliced.sort_index()
+    else:
+        spliced = sort_by_date(spliced, by)
+    spliced.to_csv(output)
+
+def compile_incremental(input_files, norm_methods={'compiled_raw': (None, None)},
+                        manifest_path='compiled_manifest.json',
+                        output_pattern='{}.csv'):
+    """
+    compile_incremental compiles the hits like compile_all and writes each
+    output to a CSV, but only recompiles the days whose hits, practices,
+    attendance, event types or game durations changed since the last run,
+    as recorded in the manifest at manifest_path. Their rows are spliced
+    into the existing outputs and labelled after the rows already there, so
+    their labels differ from a full compile's, but the rows are in the same
+    order.
+    Changing the roster tables, the durations file or the outputs redoes
+    every day. Returns the days that were recompiled, or None if all were.
+    """
+    frames = read_input_files(input_files, get_input_keys(norm_methods))
+    tables = read_tables(input_files, norm_methods, frames)
+    hits = frames['hits']
+    outputs = {name: output_pattern.format(name) for name in norm_methods}
+    practices = tables['practices']
+    manifest = {'global': hash_frames([tables['psn_to_pcode'],
+                                       tables['pcode_to_ptype'],
+                                       tables['durations'] if 'durations' in input_files else None,
+                                       pd.DataFrame([(name, outputs[name], repr(norm_methods[name]))
+                                                     for name in sorted(outputs)])]),
+                'days': get_day_hashes([hits, tables['attendance_df'],
+                                        tables['event_df'], tables['game_dur_df']] +
+                                       [practices[p] for p in sorted(practices)])}
+    stale_days = get_stale_days(manifest_path, manifest, outputs.values())
+    if stale_days is None:
+        for name, compiled in compile_hits(hits, tables, norm_methods).items():
+            compiled.to_csv(outputs[name])
+    else:
+        hits = hits[day_strings(hits.index).isin(stale_days).values]
+        first_index = get_next_label(next(iter(outputs.values())))
+        results = compile_hits(hits, tables, norm_methods, first_index)
+        for name, compiled in results.items():
+            splice_output(outputs[name], compiled, stale_days)
+    write_manifest(manifest_path, manifest)
+    return stale_days
     
 #--------------#
 # MAIN PROGRAM #
@@ -337,10 +1350,27 @@ if __name__ == '__main__':
                    'attendance': 'attendance.xlsx',
                    'event_types': 'event_type.xlsx',
                     #'game_duration': 'minutes_per_game.xlsx',
+                    #'durations': 'durations.csv',
                    'pcode_to_ptype': 'player_code_to_type.xlsx',
                    'psn_to_pcode': 'serial_number_to_position.xlsx'}
     
-    compile_data(input_files, norm_methods=(None, None)).to_csv('compiled_raw.csv') 
-    #compile_data(input_files, norm_methods=('by_position', None)).to_csv('compiled_by_position.csv')  
-    #compile_data(input_files, norm_methods=('by_activity', None)).to_csv('compiled_by_activity.csv')
-    #compile_data(input_files, norm_methods=('by_activity', 'by_time')).to_csv('compiled_by_time_activity_test.csv')
+    norm_methods = {'compiled_raw': (None, None),
+                    'compiled_by_position': ('by_position', None),
+                    'compiled_by_activity': ('by_activity', None),
+                    'compiled_total': ('total', None),
+                    #'compiled_by_time_activity': ('by_activity', 'by_time'),
+                    }
+    # Pass --profile to report where the time goes
+    profile = '--profile' in sys.argv[1:]
+    if profile:
+        start_profile(progress=True)
+    for name, compiled in compile_all(input_files, norm_methods).items():
+        compiled.to_csv('{}.csv'.format(name))
+        # The typed columns are kept in Parquet for aggregate_data.py
+        if pa is not None:
+            compiled.to_parquet('{}.parquet'.format(name))
+    if profile:
+        report = stop_profile()
+        print(format_profile(report))
+        with open('compile_profile.json', 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Code to summarize compiled hit data into an exposure cube and answer the
+exposure questions of aggregate_data.py from it
+"""
+from __future__ import print_function, division
+import os
+import pandas as pd
+import numpy as np
+
+# Dimensions of the exposure cube
+CUBE_KEYS = ['practice', 'type', 'activity', 'before_break', 'player']
+# Hit columns that the cube sums, when present in the compiled data
+HIT_COLUMNS = ['h1', 'h2', 'h3', 'h4', 'h5']
+
+def build_cube(compiled):
+    """
+    build_cube takes a compiled dataframe (as returned by compile_data) and
+    sums its hit columns per practice, practice type, activity, break side
+    and player position. The keys are stored as categoricals and the sums
+    as float64.
+    """
+    hits = [col for col in HIT_COLUMNS if col in compiled.columns]
+    keys = compiled.rename(columns={'event': 'practice'})[CUBE_KEYS]
+    cube = (pd.concat([keys, compiled[hits].astype(np.float64)], axis=1)
+              .groupby(CUBE_KEYS, as_index=False, sort=True, dropna=False,
+                       observed=True)[hits]
+              .sum())
+    for key in CUBE_KEYS:
+        cube[key] = cube[key].astype('category')
+    return cube
+
+def write_cube(cube, filename):
+    cube.to_parquet(filename, index=False)
+
+def read_cube(filename):
+    return pd.read_parquet(filename)
+
+def read_compiled(filename):
+    # Read compiled hit data from its Parquet or CSV output
+    if filename.endswith('.parquet'):
+        return pd.read_parquet(filename)
+    return pd.read_csv(filename, index_col=0)
+
+def load_cube(compiled_filename, cube_filename=None):
+    """
+    load_cube reads the exposure cube of a compiled output (Parquet or CSV),
+    building it and writing it next to the output (as
+    <name>_cube.parquet) first if it is missing or older than the output.
+    """
+    if cube_filename is None:
+        cube_filename = os.path.splitext(compiled_filename)[0] + '_cube.parquet'
+    if (not os.path.exists(cube_filename) or
+            os.path.getmtime(cube_filename) < os.path.getmtime(compiled_filename)):
+        write_cube(build_cube(read_compiled(compiled_filename)), cube_filename)
+    return read_cube(cube_filename)
+
+def select(cube, where=None, exclude=None):
+    """
+    select filters the cube. where and exclude map cube keys to a value or a
+    list of values that rows must have (where) or must not have (exclude).
+    """
+    mask = np.ones(len(cube), dtype=bool)
+    for filters, keep in ((where, True), (exclude, False)):
+        for key, values in (filters or {}).items():
+            if not isinstance(values, (list, tuple, set)):
+                values = [values]
+            mask &= cube[key].isin(values).values == keep
+    return cube[mask]
+
+def practice_totals(cube, by, where=None, exclude=None):
+    """
+    practice_totals filters the cube with where and exclude (see select) and
+    sums the hits per practice and each combination of the keys in by.
+    """
+    if isinstance(by, str):
+        by = [by]
+    hits = [col for col in HIT_COLUMNS if col in cube.columns]
+    return (select(cube, where, exclude)
+              .groupby(['practice'] + by, as_index=False, observed=True)[hits]
+              .sum())
+
+def query_cube(cube, by, where=None, exclude=None, agg=np.median):
+    """
+    query_cube answers an exposure question from the cube: it aggregates the
+    practice totals (see practice_totals), by default with the median, per
+    combination of the keys in by.
+    """
+    if isinstance(by, str):
+        by = [by]
+    hits = [col for col in HIT_COLUMNS if col in cube.columns]
+    return (practice_totals(cube, by, where, exclude)
+              .groupby(by, observed=True)[hits]
+              .aggregate(agg))
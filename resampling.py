@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Code to run bootstrap confidence intervals and permutation tests on the
+per-practice hit exposures of an exposure cube
+"""
+from __future__ import print_function, division
+import concurrent.futures
+import itertools
+import pandas as pd
+import numpy as np
+
+from exposure_cube import HIT_COLUMNS
+
+# Resamples drawn at once; a shard is the unit of work of the process pool.
+# The shards (and their seeds) do not depend on the number of workers, so a
+# seed gives the same results serially and in a pool.
+RESAMPLES_PER_SHARD = 1000
+
+def get_shard_seeds(seed_sequence, n_resamples):
+    """
+    get_shard_seeds splits n_resamples into shards of at most
+    RESAMPLES_PER_SHARD resamples and returns (size, seed) for each.
+    """
+    sizes = [RESAMPLES_PER_SHARD] * (n_resamples // RESAMPLES_PER_SHARD)
+    if n_resamples % RESAMPLES_PER_SHARD:
+        sizes.append(n_resamples % RESAMPLES_PER_SHARD)
+    return list(zip(sizes, seed_sequence.spawn(len(sizes))))
+
+def bootstrap_shard(values, size, seed):
+    """
+    bootstrap_shard takes a (practices x hit columns) array and returns the
+    column medians of size bootstrap resamples, drawn as one
+    (size x practices) index array.
+    """
+    rng = np.random.default_rng(seed)
+    idx = rng.integers(0, len(values), size=(size, len(values)))
+    return np.median(values[idx], axis=1)
+
+def permutation_shard(pooled, n_first, size, seed):
+    """
+    permutation_shard takes the pooled (practices x hit columns) array of two
+    groups, the first n_first rows being the first group, and returns the
+    difference of the group medians for size random relabellings, drawn as
+    one (size x practices) permutation array.
+    """
+    rng = np.random.default_rng(seed)
+    idx = rng.random((size, len(pooled))).argsort(axis=1)
+    permuted = pooled[idx]
+    return (np.median(permuted[:, :n_first], axis=1) -
+            np.median(permuted[:, n_first:], axis=1))
+
+def run_shards(tasks, max_workers=1):
+    """
+    run_shards runs a list of (function, args) tasks, in a pool of max_workers
+    processes (None for one per CPU) or serially with one worker.
+    """
+    if max_workers == 1:
+        return [func(*args) for func, args in tasks]
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+        futures = [executor.submit(func, *args) for func, args in tasks]
+        return [future.result() for future in futures]
+
+def get_groups(totals, by):
+    # Split the practice totals into (key, practices x hit columns) arrays
+    hits = [col for col in HIT_COLUMNS if col in totals.columns]
+    if not by:
+        return [((), totals[hits].to_numpy(dtype=np.float64))]
+    return [(key if isinstance(key, tuple) else (key,),
+             group[hits].to_numpy(dtype=np.float64))
+            for key, group in totals.groupby(by, observed=True, sort=True)]
+
+def bootstrap_medians(totals, by, n_resamples=10000, confidence=0.95,
+                      seed=None, max_workers=1):
+    """
+    bootstrap_medians takes practice totals (see
+    exposure_cube.practice_totals) and returns, per combination of the
+    columns in by, the median of each hit column with the bounds of its
+    bootstrap percentile confidence interval. The columns are (statistic,
+    hit column) with statistic one of median, low and high.
+    """
+    if isinstance(by, str):
+        by = [by]
+    hits = [col for col in HIT_COLUMNS if col in totals.columns]
+    groups = get_groups(totals, by)
+    seeds = np.random.SeedSequence(seed).spawn(len(groups))
+    tasks, shards = [], []
+    for (key, values), group_seed in zip(groups, seeds):
+        shard_seeds = get_shard_seeds(group_seed, n_resamples)
+        tasks += [(bootstrap_shard, (values, size, shard_seed))
+                  for size, shard_seed in shard_seeds]
+        shards.append(len(shard_seeds))
+    medians = run_shards(tasks, max_workers)
+
+    alpha = (1 - confidence) / 2
+    stats = {'median': [], 'low': [], 'high': []}
+    start = 0
+    for (key, values), n_shards in zip(groups, shards):
+        resampled = np.concatenate(medians[start:start + n_shards])
+        start += n_shards
+        stats['median'].append(np.median(values, axis=0))
+        stats['low'].append(np.quantile(resampled, alpha, axis=0))
+        stats['high'].append(np.quantile(resampled, 1 - alpha, axis=0))
+
+    if by:
+        index = pd.MultiIndex.from_tuples([key for key, _ in groups], names=by)
+    else:
+        index = pd.RangeIndex(len(groups))
+    return pd.concat({stat: pd.DataFrame(rows, index=index, columns=hits)
+                      for stat, rows in stats.items()}, axis=1)
+
+def permutation_contrasts(totals, between, by=None, n_resamples=10000,
+                          seed=None, max_workers=1):
+    """
+    permutation_contrasts takes practice totals (see
+    exposure_cube.practice_totals) and, per combination of the columns in by,
+    tests every pair of levels of the column between for a difference in the
+    median of each hit column. It returns the observed difference (first
+    minus second level) and the two-sided permutation p-value, as columns
+    (statistic, hit column) with statistic one of difference and p_value.
+    """
+    if by is None:
+        by = []
+    elif isinstance(by, str):
+        by = [by]
+    hits = [col for col in HIT_COLUMNS if col in totals.columns]
+    # Pair up the levels of between within each combination of by
+    by_key, contrasts = {}, []
+    for key, values in get_groups(totals, by + [between]):
+        by_key.setdefault(key[:-1], []).append((key[-1], values))
+    for key, level_values in by_key.items():
+        for (first, a), (second, b) in itertools.combinations(level_values, 2):
+            contrasts.append((key + (first, second), a, b))
+
+    seeds = np.random.SeedSequence(seed).spawn(len(contrasts))
+    tasks, shards = [], []
+    for (key, a, b), contrast_seed in zip(contrasts, seeds):
+        pooled = np.concatenate([a, b])
+        shard_seeds = get_shard_seeds(contrast_seed, n_resamples)
+        tasks += [(permutation_shard, (pooled, len(a), size, shard_seed))
+                  for size, shard_seed in shard_seeds]
+        shards.append(len(shard_seeds))
+    differences = run_shards(tasks, max_workers)
+
+    stats = {'difference': [], 'p_value': []}
+    start = 0
+    for (key, a, b), n_shards in zip(contrasts, shards):
+        permuted = np.concatenate(differences[start:start + n_shards])
+        start += n_shards
+        observed = np.median(a, axis=0) - np.median(b, axis=0)
+        # Count relabellings at least as extreme, with a small tolerance for
+        # ties lost to rounding, and include the observed labelling
+        extreme = (np.abs(permuted) >= np.abs(observed) - 1e-12).sum(axis=0)
+        stats['difference'].append(observed)
+        stats['p_value'].append((extreme + 1) / (len(permuted) + 1))
+
+    names = by + [between + '_1', between + '_2']
+    index = pd.MultiIndex.from_tuples([key for key, _, _ in contrasts],
+                                      names=names)
+    return pd.concat({stat: pd.DataFrame(rows, index=index, columns=hits)
+                      for stat, rows in stats.items()}, axis=1)
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Code to generate synthetic seasons of practice schedules, attendance, event
+types, player mappings and hit exports, in the workbook layouts the read_*
+functions of compile_data.py expect, to benchmark the pipeline at scale
+"""
+from __future__ import print_function, division
+import argparse
+import datetime
+import os
+import numpy as np
+
+# Seasons are laid end to end 52 weeks apart so that weekdays line up
+SEASON_START = datetime.datetime(2017, 7, 31)
+SEASON_SPACING = datetime.timedelta(weeks=52)
+
+HIT_SHEET = 'FINAL- bad hits and 1 out'
+HIT_LOCATIONS = ['F', 'T', 'R', 'B', 'L']
+HIT_LEVELS = [2, 3, 4, 5]
+# Chance of a hit of each level (the rest register below level 2)
+LEVEL_P = [0.45, 0.3, 0.1, 0.05]
+
+PLAYER_CODES = {'offensive': ['qbrb', 'te', 'wr', 'ot', 'og'],
+                'defensive': ['dt', 'de', 'lb', 'safety', 'cb']}
+POSITIONS = {'qbrb': 'running back', 'te': 'tight end', 'wr': 'wide receiver',
+             'ot': 'off tackle', 'og': 'off guard', 'dt': 'def tackle',
+             'de': 'def end', 'lb': 'linebacker', 'safety': 'safety',
+             'cb': 'cornerback'}
+ACTIVITIES = {'offensive': ['pat/fg', 'indy', 'otb', 'inside', 'pap', '1on1',
+                            'skell vs. def scouts', 'team vs. def scouts',
+                            'team situation', 'run session-blitz', 'punt',
+                            'kickoff', 'kor', 'punt return'],
+              'defensive': ['pat/fg', 'indy', 'tackling', 'inside', '1on1',
+                            'skell vs. off scouts', 'team vs. off scouts',
+                            'team situation', 'run session-blitz', 'punt',
+                            'kickoff', 'kor', 'punt return']}
+PRACTICE_STARTS = [datetime.time(9, 30), datetime.time(14, 30),
+                   datetime.time(15, 30), datetime.time(19, 0)]
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday',
+            'Saturday', 'Sunday']
+
+def get_schedule(start, rng):
+    """
+    get_schedule returns the (date, event type) of every practice and game
+    of the season starting on start: a camp of daily practices with two
+    scrimmages, then twelve weeks of Tuesday to Thursday practices and a
+    Saturday game.
+    """
+    schedule = []
+    for day in range(25):
+        if day in (9, 18):
+            schedule.append((start + datetime.timedelta(days=day), 'scrimmage'))
+        elif rng.random() > 0.1:
+            schedule.append((start + datetime.timedelta(days=day), 'camp'))
+    for week in range(4, 16):
+        monday = start + datetime.timedelta(weeks=week)
+        for day, event_type in ((1, 'tues'), (2, 'wed'), (3, 'thurs'), (5, 'game')):
+            schedule.append((monday + datetime.timedelta(days=day), event_type))
+    return schedule
+
+def get_periods(event_type, rng):
+    """
+    get_periods returns the (period, length in minutes) rows of one practice
+    or game, from its start to its end.
+    """
+    if event_type == 'game':
+        return [('start', 60), (1, 110), ('break', 5), (2, 100), ('end', None)]
+    n = rng.integers(8, 13)
+    lengths = rng.choice([5, 8, 10, 12, 15, 20], size=n).tolist()
+    periods = [('start', 10)] + [(i + 1, length) for i, length in enumerate(lengths)]
+    periods.insert(n // 2 + 1, ('break', 5))
+    periods.insert(len(periods) - 1, ('all up', int(rng.integers(2, 6))))
+    return periods + [('end', None)]
+
+def get_practice_rows(ptype, date, event_type, name, periods, begin, rng):
+    # Build the practice sheet rows of one player type for one day
+    codes = PLAYER_CODES[ptype]
+    equipment = 'full pads' if event_type == 'game' else rng.choice(
+        ['helmets', 'shoulder pads', 'full pads'])
+    rows, time = [], begin
+    for i, (period, length) in enumerate(periods):
+        if period == 'start':
+            activities = ['pre'] * len(codes)
+        elif period == 'end':
+            activities = ['post'] * len(codes)
+        elif period in ('break', 'all up'):
+            activities = [period] * len(codes)
+        elif event_type == 'game':
+            activities = ['first half' if period == 1 else 'second half'] * len(codes)
+        elif i == len(periods) - 2:
+            activities = ['post-practice'] * len(codes)
+        else:
+            common = rng.choice(ACTIVITIES[ptype])
+            activities = [common if rng.random() < 0.8 else
+                          rng.choice(ACTIVITIES[ptype]) for _ in codes]
+        rows.append([time, WEEKDAYS[date.weekday()], name, period, length,
+                     equipment] + [str(activity) for activity in activities])
+        if length is not None:
+            time += datetime.timedelta(minutes=length)
+    return rows
+
+def get_hit_rows(players, date, windows, rng, hits_per_day):
+    """
+    get_hit_rows returns hit export rows for the players attending on date.
+    Most hits fall in the practice window of the player's type (windows maps
+    a player type to its start and end); the rest fall up to 90 minutes
+    outside of it.
+    """
+    numbers, ptypes = players
+    n = rng.poisson(hits_per_day)
+    who = rng.integers(0, len(numbers), size=n)
+    inside = rng.random(n) < 0.95
+    rows = []
+    for i in range(n):
+        begin, end = windows[ptypes[who[i]]]
+        span = (end - begin).total_seconds()
+        if inside[i]:
+            offset = rng.random() * span
+        elif rng.random() < 0.5:
+            offset = -rng.random() * 5400
+        else:
+            offset = span + rng.random() * 5400
+        when = begin + datetime.timedelta(seconds=int(offset // 60) * 60)
+        cells = np.zeros((len(HIT_LEVELS), len(HIT_LOCATIONS)), dtype=int)
+        level = rng.choice(len(HIT_LEVELS) + 1, p=LEVEL_P + [1 - sum(LEVEL_P)])
+        if level < len(HIT_LEVELS):
+            cells[level, rng.integers(len(HIT_LOCATIONS))] = 1
+        sums = cells.sum(axis=1).tolist()
+        rows.append([int(numbers[who[i]]),
+                     datetime.datetime.combine(when.date(), datetime.time()),
+                     when.time()] +
+                    cells.T.ravel().tolist() + sums + [sum(sums[:3])])
+    return rows
+
+def write_workbook(filename, sheets):
+    """
+    write_workbook writes a workbook with one sheet for each entry of
+    sheets, which maps a sheet name to its header and rows.
+    """
+    # openpyxl is only needed to write the synthetic workbooks
+    import openpyxl
+    workbook = openpyxl.Workbook(write_only=True)
+    for name, (header, rows) in sheets.items():
+        sheet = workbook.create_sheet(name)
+        sheet.append(header)
+        for row in rows:
+            sheet.append(row)
+    workbook.save(filename)
+
+def generate_season(directory, scale=1, seed=0, hits_per_day=67):
+    """
+    generate_season writes scale consecutive synthetic seasons to directory
+    and returns the input_files dict for compile_data. Every season has the
+    same roster of twenty players, two per player code.
+    """
+    rng = np.random.default_rng(seed)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    roster = [(number + 1, code) for number, code in
+              enumerate(PLAYER_CODES['defensive'] + PLAYER_CODES['offensive'] +
+                        PLAYER_CODES['defensive'] + PLAYER_CODES['offensive'])]
+    ptype_of = {code: ptype for ptype in PLAYER_CODES for code in PLAYER_CODES[ptype]}
+    numbers = np.array([number for number, _ in roster])
+    ptypes = [ptype_of[code] for _, code in roster]
+    all_codes = PLAYER_CODES['offensive'] + PLAYER_CODES['defensive']
+
+    practices = {'offensive': [], 'defensive': []}
+    attendance, event_types, hits = [], [], []
+    # Events are numbered across seasons so that practice names stay unique
+    schedule = [event for season in range(scale) for event in
+                get_schedule(SEASON_START + season * SEASON_SPACING, rng)]
+    for i, (date, event_type) in enumerate(schedule):
+        if event_type == 'game':
+            name = 'Opponent {} Game'.format(i)
+            begin = datetime.datetime.combine(date, datetime.time(17, 30))
+        else:
+            name = '{} practice #{}'.format(event_type, i + 1)
+            begin = datetime.datetime.combine(
+                date, PRACTICE_STARTS[rng.integers(len(PRACTICE_STARTS))])
+        periods = get_periods(event_type, rng)
+        windows = {}
+        for ptype in practices:
+            # The defense sometimes starts ten minutes before the offense
+            offset = (datetime.timedelta(minutes=-10)
+                      if ptype == 'defensive' and rng.random() < 0.5
+                      else datetime.timedelta())
+            rows = get_practice_rows(ptype, date, event_type, name, periods,
+                                     begin + offset, rng)
+            practices[ptype] += rows
+            windows[ptype] = (rows[0][0], rows[-1][0])
+        present = rng.random(len(roster)) < 0.93
+        counts = {code: int(sum(present[j] for j, (_, c) in enumerate(roster)
+                                if c == code)) for code in all_codes}
+        attendance.append([date] + present.astype(int).tolist() +
+                          [counts[code] for code in PLAYER_CODES['defensive'][::-1]] +
+                          [counts[code] for code in PLAYER_CODES['offensive']] +
+                          [int(present.sum()),
+                           sum(counts[code] for code in PLAYER_CODES['offensive']),
+                           sum(counts[code] for code in PLAYER_CODES['defensive'])])
+        event_types.append([date, event_type])
+        attending = (numbers[present], [p for p, keep in zip(ptypes, present) if keep])
+        if present.any():
+            hits += get_hit_rows(attending, date, windows, rng,
+                                 hits_per_day * (2 if event_type == 'game' else 1))
+    # Hit exports are not in time order
+    hits = [hits[i] for i in rng.permutation(len(hits))]
+
+    practice_header = ['date', 'day', 'name', 'period', 'length', 'type']
+    input_files = {'hits': os.path.join(directory, 'hits.xlsx'),
+                   'practices': os.path.join(directory, 'practices.xlsx'),
+                   'attendance': os.path.join(directory, 'attendance.xlsx'),
+                   'event_types': os.path.join(directory, 'event_type.xlsx'),
+                   'pcode_to_ptype': os.path.join(directory, 'player_code_to_type.xlsx'),
+                   'psn_to_pcode': os.path.join(directory, 'serial_number_to_position.xlsx')}
+    write_workbook(input_files['hits'], {HIT_SHEET: (
+        ['Number', '\tCorrected date', 'Corrected time'] +
+        ['{}{}'.format(location, level) for location in HIT_LOCATIONS
+         for level in HIT_LEVELS] +
+        ['sum {}'.format(level) for level in HIT_LEVELS] + ['sum 2-4'], hits)})
+    write_workbook(input_files['practices'], {
+        ptype: (practice_header + PLAYER_CODES[ptype], practices[ptype])
+        for ptype in ('offensive', 'defensive')})
+    write_workbook(input_files['attendance'], {'Sheet1': (
+        ['date'] + numbers.tolist() + PLAYER_CODES['defensive'][::-1] +
+        PLAYER_CODES['offensive'] + ['total', 'offensive', 'defensive'], attendance)})
+    write_workbook(input_files['event_types'], {'Sheet1': (['date', 'type'], event_types)})
+    write_workbook(input_files['pcode_to_ptype'], {'Sheet1': (
+        ['type'] + all_codes,
+        [[ptype] + [int(ptype_of[code] == ptype) for code in all_codes]
+         for ptype in ('offensive', 'defensive')])})
+    write_workbook(input_files['psn_to_pcode'], {'serial_number_to_position': (
+        ['number', 'position', 'code'],
+        [[number, POSITIONS[code], code] for number, code in roster])})
+    return input_files
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic seasons.')
+    parser.add_argument('directory')
+    parser.add_argument('--scale', type=int, default=1,
+                        help='number of seasons (e.g. 1, 10 or 100)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generate_season(args.directory, args.scale, args.seed)